@@ -0,0 +1,234 @@
+#! /usr/bin/env python3
+"""
+Acquisition benchmark suite. Runs read_spec, read_corr, get_new_corr and
+the FITS writing path against the simulated SNAP and reports:
+- sustained integrations per second,
+- p50/p99 latency from the acc_cnt increment to the data being on disk,
+- peak RSS as nspec grows,
+- output bytes per spectrum.
+
+The writer_* and *_int cases compare the output encodings (float64,
+float32, raw integers) and gzip compression; the writer cases store
+simulated spectra so that the compressed sizes are realistic.
+
+Every case runs in a fresh interpreter so that peak RSS is per case.
+Results are saved as JSON and can be compared with an earlier run:
+
+    python scripts/bench_acquisition.py -o new.json --compare old.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(SRC)
+
+# name: (function, keyword arguments)
+CASES = {
+    'read_spec_hdu': ('read_spec', {'layout': 'hdu'}),
+    'read_spec_table': ('read_spec', {'layout': 'table'}),
+    'read_spec_threaded': ('read_spec', {'layout': 'table', 'threaded': True}),
+    'read_spec_memory': ('read_spec', {'layout': 'hdu', 'stream': False}),
+    'read_corr_hdu': ('read_corr', {'layout': 'hdu'}),
+    'read_all_serial': ('read_all', {'layout': 'table', 'parallel': False}),
+    'read_all_parallel': ('read_all', {'layout': 'table', 'parallel': True}),
+    'get_new_corr': ('get_new_corr', {}),
+    'read_spec_table_int': ('read_spec', {'layout': 'table', 'encoding': 'int'}),
+    'writer_hdu': ('writer', {'layout': 'hdu'}),
+    'writer_table': ('writer', {'layout': 'table'}),
+    'writer_table_float32': ('writer', {'layout': 'table', 'encoding': 'float32'}),
+    'writer_table_int': ('writer', {'layout': 'table', 'encoding': 'int'}),
+    'writer_table_gzip': ('writer', {'layout': 'table', 'compress': 'gzip'}),
+    'writer_table_float32_gzip': ('writer', {'layout': 'table', 'encoding': 'float32', 'compress': 'gzip'}),
+    'writer_table_int_gzip': ('writer', {'layout': 'table', 'encoding': 'int', 'compress': 'gzip'}),
+}
+COORDS = (120., 0.)
+
+
+def percentile(values, q):
+    """
+    q-th percentile of ''values'', or None if there are none.
+    """
+    if not values:
+        return None
+    import numpy as np
+    return float(np.percentile(values, q))
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process [bytes].
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss*1024
+
+
+def make_spectrometer(dump_period, read_latency):
+    import leuschner
+    from leuschner_sim import SimBackend
+    backend = SimBackend(dump_period=dump_period, read_latency=read_latency)
+    spec = leuschner.Spectrometer(logger=os.devnull, backend=backend)
+    spec.initialize()
+    return spec
+
+
+def install_timed_writer(latencies, state):
+    """
+    Replace leuschner's FitsStreamWriter with a subclass that records, for
+    every integration, the time from its accumulation dump to the flush
+    that put it on disk.
+    """
+    import leuschner
+
+    class TimedWriter(leuschner.FitsStreamWriter):
+        def write(self, data, meta=None):
+            if meta is not None and 'acc_cnt' in meta:
+                self._flush_cnts = getattr(self, '_flush_cnts', []) + [meta['acc_cnt']]
+            super(TimedWriter, self).write(data, meta)
+
+        def flush(self):
+            super(TimedWriter, self).flush()
+            now = time.time()
+            for cnt in getattr(self, '_flush_cnts', []):
+                latencies.append(now - state.dump_time(cnt))
+            self._flush_cnts = []
+
+    leuschner.FitsStreamWriter = TimedWriter
+
+
+def run_case(name, nspec, dump_period, read_latency):
+    """
+    Run one benchmark case in this process.
+    Returns:
+    - Dictionary of results.
+    """
+    import numpy as np
+    import leuschner
+    func, kwargs = CASES[name]
+    result = {'case': name, 'nspec': nspec}
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, name + '.fits')
+
+    spec = make_spectrometer(dump_period, read_latency)
+    latencies = []
+    install_timed_writer(latencies, spec.backend.state)
+    spec.make_PrimaryHDU(nspec, COORDS) # keep the one-time astropy cost out of the timing
+
+    t0 = time.perf_counter()
+    if func in ('read_spec', 'read_corr', 'read_all'):
+        summary = getattr(spec, func)(filename, nspec, COORDS, **kwargs)
+        result['missed'] = summary['missed']
+    elif func == 'get_new_corr':
+        for i in range(nspec):
+            spec.get_new_corr(spec.s.corr_0, 0, 0)
+    elif func == 'writer':
+        primaryhdu = spec.make_PrimaryHDU(nspec, COORDS)
+        state = spec.backend.state
+        norm = spec._norm
+        spectra = [{'auto0_real': state.spectrum(i, 0, 0).real*norm, 'auto1_real': state.spectrum(i, 1, 1).real*norm}
+                   for i in range(8)]
+        t0 = time.perf_counter()
+        writer = leuschner.FitsStreamWriter(filename, primaryhdu, scale=norm, **kwargs)
+        for i in range(nspec):
+            writer.write(spectra[i % len(spectra)], meta={'acc_cnt': i, 'unix': time.time()})
+        writer.close()
+        filename = writer.filename
+    elapsed = time.perf_counter() - t0
+
+    result['elapsed'] = elapsed
+    result['rate'] = nspec/elapsed
+    if func not in ('writer', 'get_new_corr'):
+        result['latency_p50'] = percentile(latencies, 50)
+        result['latency_p99'] = percentile(latencies, 99)
+    if os.path.exists(filename):
+        result['bytes_per_spectrum'] = os.path.getsize(filename)/float(nspec)
+        os.remove(filename)
+    os.rmdir(tmpdir)
+    result['peak_rss'] = peak_rss()
+    return result
+
+
+def run_isolated(name, nspec, args):
+    """
+    Run one case in a fresh interpreter and return its results.
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--run-case', name, '--nspec', str(nspec),
+           '--dump-period', str(args.dump_period), '--read-latency', str(args.read_latency)]
+    return json.loads(subprocess.check_output(cmd).decode().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=SRC,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, old):
+    """
+    Print the change of every metric relative to an earlier run.
+    """
+    old_results = dict(((r['case'], r['nspec']), r) for r in old['results'])
+    print('\nComparison with %s:' % (old.get('commit') or 'previous run'))
+    for r in results:
+        prev = old_results.get((r['case'], r['nspec']))
+        if prev is None:
+            continue
+        changes = []
+        for key in ('rate', 'latency_p50', 'latency_p99', 'peak_rss', 'bytes_per_spectrum'):
+            if r.get(key) is not None and prev.get(key):
+                changes.append('%s %+.1f%%' % (key, 100.*(r[key]/prev[key] - 1)))
+        print('%-20s %6d  %s' % (r['case'], r['nspec'], ', '.join(changes)))
+
+
+def report(r):
+    def ms(value):
+        return '%8.2f' % (1e3*value) if value is not None else '       -'
+    print('%-20s %6d %10.1f %s %s %8.1f %10s' % (
+        r['case'], r['nspec'], r['rate'], ms(r.get('latency_p50')), ms(r.get('latency_p99')),
+        r['peak_rss']/2.**20, '%.0f' % r['bytes_per_spectrum'] if 'bytes_per_spectrum' in r else '-'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark spectrometer acquisition against the simulated SNAP.')
+    parser.add_argument('-c', '--cases', nargs='+', default=sorted(CASES), choices=sorted(CASES),
+                        help='benchmark cases to run')
+    parser.add_argument('-n', '--nspec', type=int, nargs='+', default=[100, 1000],
+                        help='number of spectra per run; several values show RSS growth')
+    parser.add_argument('--dump-period', type=float, default=0.002, help='simulated dump period [s]')
+    parser.add_argument('--read-latency', type=float, default=0., help='simulated latency per read [s]')
+    parser.add_argument('-o', '--output', default='bench_results.json', help='JSON file for the results')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args.nspec[0], args.dump_period, args.read_latency)))
+        sys.exit(0)
+
+    print('%-20s %6s %10s %8s %8s %8s %10s' % ('case', 'nspec', 'spec/s', 'p50 ms', 'p99 ms', 'RSS MB', 'B/spec'))
+    results = []
+    for name in args.cases:
+        for nspec in args.nspec:
+            r = run_isolated(name, nspec, args)
+            report(r)
+            results.append(r)
+
+    output = {'commit': git_commit(), 'time': time.time(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'dump_period': args.dump_period,
+              'read_latency': args.read_latency, 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print('\nResults saved to ' + args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,73 @@
+#! /usr/bin/env python3
+"""
+Benchmark the startup cost of the leuschner module: the time to
+''import leuschner'' in a fresh interpreter and the time to construct a
+Spectrometer against the simulated SNAP backend (no SNAP needed).
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(SRC)
+
+HEAVY_MODULES = ['casperfpga', 'hera_corr_f', 'ugradio', 'astropy', 'astropy.io.fits',
+                 'astropy.coordinates', 'astropy.time', 'matplotlib']
+
+IMPORT_SNIPPET = """
+import sys, time
+sys.path.insert(0, %r)
+t0 = time.perf_counter()
+import leuschner
+t1 = time.perf_counter()
+print(t1 - t0)
+print(','.join(m for m in %r if m in sys.modules))
+""" % (SRC, HEAVY_MODULES)
+
+
+def time_import(repeat):
+    """
+    Time ''import leuschner'' in fresh interpreters.
+    Returns:
+    - List of import times [s] and the heavy modules loaded by the import.
+    """
+    times = []
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', IMPORT_SNIPPET]).decode().splitlines()
+        times.append(float(out[0]))
+        loaded = out[1].split(',') if len(out) > 1 and out[1] else []
+    return times, loaded
+
+
+def time_construct(repeat, logfile):
+    """
+    Time constructing a Spectrometer against the simulated SNAP backend.
+    """
+    from leuschner import Spectrometer
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        Spectrometer(logger=logfile, backend='sim')
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def report(name, times):
+    times = sorted(times)
+    print('%-28s min %8.2f ms   median %8.2f ms   max %8.2f ms' %
+          (name, 1e3*times[0], 1e3*times[len(times)//2], 1e3*times[-1]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark leuschner import and Spectrometer construction time.')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='number of repetitions')
+    parser.add_argument('--log', default=os.devnull, help='log file used by the Spectrometer')
+    args = parser.parse_args()
+
+    import_times, loaded = time_import(args.repeat)
+    report('import leuschner', import_times)
+    print('heavy modules loaded at import: %s' % (', '.join(loaded) or 'none'))
+    report('Spectrometer() (sim)', time_construct(args.repeat, args.log))
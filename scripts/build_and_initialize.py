@@ -1,21 +1,22 @@
 #! /usr/bin/env python3
 
-import casperfpga
-from hera_corr_f import SnapFengine
 import argparse
 
 from leuschner import Spectrometer
 
 parser = argparse.ArgumentParser(description='Run spectrometer.')
 parser.add_argument('fpga', type=str, help='fpg file')
+parser.add_argument('--force', action='store_true', help='reprogram even if the SNAP already runs this fpg file')
+parser.add_argument('--retries', type=int, default=2, help='retries of a failed initialization stage')
+parser.add_argument('--backoff', type=float, default=0.5, help='seconds before the first retry of a stage')
 args = parser.parse_args()
 FPGA = args.fpga
 
-fpga = casperfpga.CasperFpga('localhost')
-fpga.upload_to_ram_and_program(FPGA)
-s = SnapFengine('localhost', transport='default')
-
+# Spectrometer.initialize programs the fpga once (or skips it if the 
+# same bitstream is already running) for both fpga handles
 spec = Spectrometer(fpgfile=FPGA)
-spec.initialize()
+result = spec.initialize(force_program=args.force, retries=args.retries, backoff=args.backoff)
+for stage in result['stages']:
+    print('%-12s %8.3f s  %d attempt(s)' % (stage['stage'], stage['duration'], stage['attempts']))
 
 import IPython; IPython.embed()
@@ -1,7 +1,22 @@
-import casperfpga
-from hera_corr_f import SnapFengine
+#! /usr/bin/env python3
+"""
+Collect SNAP correlator spectra of two polarizations and plot them live.
+The spectra are published to shared memory (see ''Spectrometer.share'')
+and plotted by scripts/quicklook.py in its own process, so the display
+never blocks the acquisition. Stop with Ctrl-C.
+
+    python scripts/collect_corr_spec.py -pol1 0 -pol2 1
+"""
 
 import argparse
+import os
+import subprocess
+import sys
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(SRC)
+
+from leuschner import Spectrometer
 
 
 #--------------------------------------------------------------------------
@@ -11,48 +26,40 @@ parser.add_argument('-pol1', action='store', dest='pol1', help='Specify a first
 
 parser.add_argument('-pol2', action='store', dest='pol2', help='Specify a second polarization to correlate.')
 
+parser.add_argument('--sim', action='store_true', help='Use the simulated SNAP.')
+
+parser.add_argument('--no-plot', action='store_true', help='Only share the spectra, e.g. to run quicklook.py elsewhere.')
+
 args = parser.parse_args()
 print('pol1 = {0}'.format(int(args.pol1)))
 print('pol2 = {0}'.format(int(args.pol2)))
 #--------------------------------------------------------------------------
 
-def take_corr_data(pol1, pol2):
+def take_corr_data(pol1, pol2, sim=False, plot=True):
 
-    # Make fpga object and program the fpga
-    fpga = casperfpga.CasperFpga('localhost')
-    fpga.upload_to_ram_and_program('ugradio_corrspec_2022-02-22_0905.fpg')
+    # Program the fpga, initialize and align the ADCs and initialize the blocks
+    spec = Spectrometer(backend='sim' if sim else None)
+    spec.initialize()
+    print("\nSpectrometer initialized. \nNow collecting and plotting spectra...")
 
-    # Make SnapFengine object, program fpga, initialize adcs, and align adcs
-    s = SnapFengine('localhost', transport='default')
-    s.fpga.upload_to_ram_and_program('ugradio_corrspec_2022-02-22_0905.fpg')
-    if s.is_programmed():
-        print("\nFpga programed. \nInitializing ADCs...")
-    else:
-        raise IOError("\nCannot program fpga.")
-    try:
-        s.adc.init()
-        s.align_adc()
-        print("\nADCs aligned and initialized.")
-    except:
-        print("\nCould not properly initialize the ADCs first time around. Trying again...")
-        try:
-            s.adc.init()
-            s.align_adc()
-            print("\nADCs aligned and initialized.")
-        except:
-            raise IOError("\nSecond attempt at ADC initialization failed.")
-            
-    # Initialize blocks
-    print("\nInitializing other blocks, including PFB and correlator blocks.")
+    # Share the spectra and display them from another process
+    name = spec.share()
+    viewer = None
+    if plot:
+        viewer = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), 'quicklook.py'),
+                                   '--name', name])
+    products = [('corr', 'corr_0', (pol1, pol2))]
     try:
-        s.initialize()
-    except:
-        s.pfb.initialize()
-        s.corr.initialize()
-    print("\nBlocks initialized. \nNow collecting and plotting spectra...")
-
-    # Collect some spectra and display it
-    s.corr.plot_corr(pol1, pol2, show=True)
+        for dump in spec.iter_dumps(products=products):
+            if viewer is not None and viewer.poll() is not None:
+                break # plot window closed
+    except KeyboardInterrupt:
+        pass
+    finally:
+        spec.unshare()
+        if viewer is not None and viewer.poll() is None:
+            viewer.terminate()
+    print("\nCollected %(nspec)d spectra, %(missed)d dumps missed." % spec.dump_stats.summary())
 
 if __name__ == "__main__":
-    take_corr_data(int(args.pol1), int(args.pol2))
+    take_corr_data(int(args.pol1), int(args.pol2), args.sim, not args.no_plot)
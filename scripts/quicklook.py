@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+"""
+Live quicklook plot of the spectra published to shared memory by a
+running acquisition (see ''Spectrometer.share''). It runs as its own
+process and only reads the shared-memory ring, so slow plotting can never
+delay the readout; it just skips dumps.
+
+In the acquiring process:
+
+    spec.share()
+    spec.read_spec('obs.fits', 1000, (120., 0.))
+
+and in another terminal (with ''--host'' if the SNAP is not the default
+one, as each board shares under its own name):
+
+    python scripts/quicklook.py
+"""
+
+import argparse
+import os
+import sys
+import time
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(SRC)
+
+
+def attach(name, timeout):
+    """
+    Attach to the shared-memory ring, waiting for it to be created.
+    """
+    from leuschner import SharedRingReader
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return SharedRingReader(name)
+        except FileNotFoundError:
+            if time.time() > deadline:
+                raise IOError('No shared spectra named %s after %.0f s.' % (name, timeout))
+            time.sleep(0.5)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plot the live spectra shared by a running acquisition.')
+    parser.add_argument('--host', default=None, help='SNAP of the acquisition (default: leuschner.HOST)')
+    parser.add_argument('-n', '--name', default=None, help='name of the shared memory (default: from --host)')
+    parser.add_argument('-r', '--rate', type=float, default=2., help='plot updates per second')
+    parser.add_argument('--log', action='store_true', help='logarithmic power axis')
+    parser.add_argument('--timeout', type=float, default=60., help='seconds to wait for an acquisition')
+    args = parser.parse_args()
+
+    import numpy as np
+    import matplotlib.pyplot as plt
+    import leuschner
+
+    if args.name is None:
+        args.name = leuschner.shared_name(args.host or leuschner.HOST)
+
+    ring = attach(args.name, args.timeout)
+    fig, ax = plt.subplots()
+    lines = {}
+    while plt.fignum_exists(fig.number):
+        if ring.closed:
+            # A new acquisition may share other products under the same name
+            ring.close()
+            ring = attach(args.name, args.timeout)
+            for line in lines.values():
+                line.remove()
+            lines = {}
+        dump = ring.latest()
+        if dump is not None:
+            for product, spectrum in dump['data'].items():
+                power = np.abs(spectrum)
+                if product not in lines:
+                    lines[product], = ax.plot(power, label=product)
+                    ax.legend(loc='upper right')
+                else:
+                    lines[product].set_ydata(power)
+            ax.set_yscale('log' if args.log else 'linear')
+            ax.relim()
+            ax.autoscale_view()
+            ax.set_title('acc_cnt %d (%.1f s ago), %d dumps shared' % (
+                dump['acc_cnt'], time.time() - dump['unix'], ring.nwritten))
+        plt.pause(1./args.rate)
+    ring.close()
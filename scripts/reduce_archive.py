@@ -0,0 +1,266 @@
+#! /usr/bin/env python3
+"""
+Batch reduction of a directory of spectrometer FITS files, in either
+layout (see ''leuschner.FitsStreamWriter''), on a pool of processes.
+Every file is read in chunks through a memory map (see
+''leuschner.SpectrumReader''), so memory use does not grow with the file
+size, and produces ''<output>/<name>.npz'' with:
+- mean_<product>: time-averaged spectrum of every product,
+- waterfall_<product>: (time, channel) array averaged over ''--tbin''
+    integrations and ''--nbin'' channels,
+- unix, acc_cnt: time and first acc_cnt of every waterfall row (NaN and
+    -1 for files without per-integration metadata),
+- header: JSON of the primary header.
+
+The reduced files are then merged into ''<output>/merged.fits'', a
+'table' layout file with one row per input file holding its mean spectra
+and observation metadata, and ''<output>/merged_waterfall.npz'' with the
+waterfalls of all files concatenated in time.
+
+Files whose reduction is up to date (same source size, modification time
+and parameters) are skipped, so the reduction can be rerun as files are
+added. Files with a checkpoint (acquisition still running or interrupted)
+are skipped as well.
+
+    python scripts/reduce_archive.py data/ -o reduced/ --tbin 10 --nbin 4 -j 8
+"""
+
+import argparse
+import glob
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(SRC)
+
+PATTERNS = ('*.fits', '*.fits.gz')
+CHUNK = 256 # integrations read at a time
+MERGE_KEYS = ('UNIX', 'JD', 'L', 'B', 'RA', 'DEC', 'NSPEC', 'NMISSED', 'NDESYNC', 'INTTIME')
+MERGED = 'merged.fits'
+MERGED_WATERFALL = 'merged_waterfall.npz'
+
+
+def find_files(directory, recursive=False):
+    """
+    FITS files of ''directory'' that are complete, i.e. without a
+    checkpoint (see ''leuschner.read_manifest'').
+    """
+    files = []
+    for pattern in PATTERNS:
+        if recursive:
+            pattern = os.path.join('**', pattern)
+        files += glob.glob(os.path.join(directory, pattern), recursive=recursive)
+    complete = []
+    for path in sorted(set(files)):
+        if os.path.basename(path) == MERGED:
+            continue
+        if os.path.exists(path + '.ckpt') or os.path.exists(path[:-3] + '.ckpt'):
+            print('Skipping %s: acquisition not complete.' % path)
+            continue
+        complete.append(path)
+    return complete
+
+
+def output_path(path, directory, outdir):
+    """
+    Reduced file of ''path'', keeping the relative directory structure.
+    """
+    name = os.path.relpath(path, directory)
+    for ext in ('.gz', '.fits'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return os.path.join(outdir, name + '.npz')
+
+
+def source_stat(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def is_current(path, out, params):
+    """
+    Whether ''out'' is the reduction of the current ''path'' with
+    ''params''.
+    """
+    try:
+        with np.load(out) as reduced:
+            return (json.loads(str(reduced['source'])) == source_stat(path) and
+                    json.loads(str(reduced['params'])) == params)
+    except (IOError, KeyError, ValueError):
+        return False
+
+
+def bin_spectra(spectra, tbin, nbin):
+    """
+    Average (time, channel) spectra over ''tbin'' rows and ''nbin''
+    channels. A partial last time bin is averaged over its rows.
+    """
+    nrow, nchan = spectra.shape
+    if nchan % nbin:
+        raise ValueError("nbin must divide the %d channels: %d" % (nchan, nbin))
+    starts = np.arange(0, nrow, tbin)
+    counts = np.diff(np.append(starts, nrow))
+    binned = np.add.reduceat(spectra, starts, axis=0)/counts[:, None]
+    return binned.reshape(len(starts), nchan//nbin, nbin).mean(axis=2)
+
+
+def reduce_file(path, out, params, chunk=CHUNK):
+    """
+    Reduce one file. Runs in a worker process.
+    Returns:
+    - Dictionary with the ''path'', its number of integrations
+      (''nspec'') and the reduction time [s].
+    """
+    import leuschner
+    start_time = time.perf_counter()
+    tbin, nbin = params['tbin'], params['nbin']
+    tmpdir = None
+    source = path
+    if path.endswith('.gz'):
+        # The reader maps the file, so decompress it first
+        tmpdir = tempfile.mkdtemp(prefix='reduce_')
+        source = os.path.join(tmpdir, os.path.basename(path)[:-3])
+        with gzip.open(path, 'rb') as f_in, open(source, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    try:
+        # No cached index: the archive is only read, and a file is indexed once per reduction
+        with leuschner.SpectrumReader(source, cache=False) as reader:
+            nspec = len(reader)
+            products = reader.products
+            chunk = max(chunk//tbin, 1)*tbin # chunks of whole time bins
+            sums = dict((product, 0.) for product in products)
+            rows = dict((product, []) for product in products)
+            for start in range(0, nspec, chunk):
+                data = reader.read(products, start, min(start + chunk, nspec))
+                for product, spectra in data.items():
+                    spectra = np.asarray(spectra, dtype=float)
+                    sums[product] = sums[product] + spectra.sum(axis=0)
+                    rows[product].append(bin_spectra(spectra, tbin, nbin))
+
+            starts = np.arange(0, nspec, tbin)
+            counts = np.diff(np.append(starts, nspec))
+            unix = np.full(len(starts), np.nan)
+            acc_cnt = np.full(len(starts), -1, dtype=np.int64)
+            if nspec and 'unix' in reader.meta:
+                unix = np.add.reduceat(np.asarray(reader.meta['unix'], dtype=float), starts)/counts
+            if nspec and 'acc_cnt' in reader.meta:
+                acc_cnt = np.asarray(reader.meta['acc_cnt'], dtype=np.int64)[starts]
+            header = dict((key, value) for key, value in reader.header.items()
+                          if key and isinstance(value, (bool, int, float, str)))
+
+        arrays = {'unix': unix, 'acc_cnt': acc_cnt, 'nspec': nspec, 'header': json.dumps(header),
+                  'source': json.dumps(source_stat(path)), 'params': json.dumps(params)}
+        for product in products:
+            arrays['mean_' + product] = sums[product]/max(nspec, 1)
+            arrays['waterfall_' + product] = (np.concatenate(rows[product]) if rows[product]
+                                              else np.empty((0, leuschner.NCHAN//nbin)))
+        # Write atomically so that an interrupted run leaves no partial output
+        os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+        tmp = out + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, out)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+    return {'path': path, 'nspec': nspec, 'elapsed': time.perf_counter() - start_time}
+
+
+def merge(outputs, outdir):
+    """
+    Merge the reduced files into ''merged.fits'' and
+    ''merged_waterfall.npz'', ordered by start time.
+    """
+    import leuschner
+    from astropy.io import fits
+    reduced = []
+    for path, out in outputs:
+        with np.load(out) as f:
+            item = dict((key, f[key]) for key in f.files)
+        item['path'] = path
+        item['header'] = json.loads(str(item['header']))
+        reduced.append(item)
+    if not reduced:
+        return
+    reduced.sort(key=lambda item: item['header'].get('UNIX', 0.))
+    products = [key[5:] for key in reduced[0] if key.startswith('mean_')]
+    common = [product for product in products if all('mean_' + product in item for item in reduced)]
+    if len(common) < len(products):
+        print('Merging the products common to all files: %s' % ', '.join(common))
+
+    header = fits.Header()
+    header['NFILES'] = (len(reduced), "Number of files merged")
+    params = json.loads(str(reduced[0]['params']))
+    header['TBIN'] = (params['tbin'], "Integrations per waterfall row")
+    header['NBIN'] = (params['nbin'], "Channels per waterfall column")
+    for i, item in enumerate(reduced):
+        header.add_comment('row %d: %s' % (i, os.path.basename(item['path'])))
+    filename = os.path.join(outdir, MERGED)
+    with leuschner.FitsStreamWriter(filename, fits.PrimaryHDU(header=header), layout='table') as writer:
+        for i, item in enumerate(reduced):
+            meta = {'file_index': i}
+            for key in MERGE_KEYS:
+                meta[key.lower()] = float(item['header'].get(key, np.nan))
+            writer.write(dict((product, item['mean_' + product]) for product in common), meta=meta)
+
+    waterfalls = {'files': np.array([item['path'] for item in reduced]),
+                  'unix': np.concatenate([item['unix'] for item in reduced]),
+                  'acc_cnt': np.concatenate([item['acc_cnt'] for item in reduced]),
+                  'file_index': np.concatenate([np.full(len(item['unix']), i) for i, item in enumerate(reduced)])}
+    for product in common:
+        waterfalls[product] = np.concatenate([item['waterfall_' + product] for item in reduced])
+    np.savez(os.path.join(outdir, MERGED_WATERFALL), **waterfalls)
+    print('Merged %d files into %s and %s.' % (len(reduced), filename, MERGED_WATERFALL))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reduce a directory of spectrometer FITS files in parallel.')
+    parser.add_argument('directory', help='directory of FITS files')
+    parser.add_argument('-o', '--output', default='reduced', help='output directory')
+    parser.add_argument('-r', '--recursive', action='store_true', help='also reduce files in subdirectories')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--tbin', type=int, default=1, help='integrations averaged per waterfall row')
+    parser.add_argument('--nbin', type=int, default=1, help='channels averaged per waterfall column')
+    parser.add_argument('--chunk', type=int, default=CHUNK, help='integrations read at a time')
+    parser.add_argument('-f', '--force', action='store_true', help='reduce files that are up to date too')
+    parser.add_argument('--no-merge', action='store_true', help='only reduce the files')
+    args = parser.parse_args()
+    if args.tbin < 1 or args.nbin < 1:
+        parser.error('--tbin and --nbin must be at least 1')
+
+    params = {'tbin': args.tbin, 'nbin': args.nbin}
+    files = find_files(args.directory, args.recursive)
+    outputs = [(path, output_path(path, args.directory, args.output)) for path in files]
+    todo = [(path, out) for path, out in outputs if args.force or not is_current(path, out, params)]
+    print('%d files, %d to reduce with %d processes.' % (len(files), len(todo), args.jobs))
+
+    t0 = time.perf_counter()
+    failed = []
+    nspec = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = dict((pool.submit(reduce_file, path, out, params, args.chunk), path) for path, out in todo)
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                result = future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                print('[%d/%d] %s failed: %s' % (i + 1, len(todo), futures[future], e))
+                continue
+            nspec += result['nspec']
+            print('[%d/%d] %s: %d spectra in %.2f s' % (i + 1, len(todo), result['path'], result['nspec'],
+                                                       result['elapsed']))
+    elapsed = time.perf_counter() - t0
+    if todo:
+        print('Reduced %d spectra in %.1f s (%.0f spectra/s).' % (nspec, elapsed, nspec/elapsed))
+
+    if not args.no_merge:
+        merge([(path, out) for path, out in outputs if os.path.exists(out)], args.output)
+    sys.exit(1 if failed else 0)
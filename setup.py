@@ -13,6 +13,6 @@ if __name__ == '__main__':
           author_email = 'darbymccauley@berkeley.edu',
           url = 'https://github.com/darbymccauley/Leuschner_Spectrometer',
           package_dir = {'':'src'},
-          py_modules = ['leuschner'],
+          py_modules = ['leuschner', 'leuschner_sim', 'leuschner_async'],
           scripts = glob.glob('scipts/*.py')
           )  
@@ -1,25 +1,2207 @@
-import casperfpga
-from hera_corr_f import SnapFengine
-import ugradio
+import numpy as np
+import time 
+import logging
+import logging.handlers
+import atexit
+import gzip
+import shutil
+import bisect
+import hashlib
+import json
+import pickle
+import re
+import importlib
+import os, sys
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Lazily imported dependencies
+class _LazyModule(object):
+    """
+    Stand-in for a module that is only imported the first time one of 
+    its attributes is used. Keeps ''import leuschner'' fast for offline
+    tasks that never touch the hardware or astropy.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_name'])
+            self.__dict__['_module'] = module
+        return getattr(module, attr)
+
+casperfpga = _LazyModule('casperfpga')
+hera_corr_f = _LazyModule('hera_corr_f')
+ugradio = _LazyModule('ugradio')
+coordinates = _LazyModule('astropy.coordinates')
+u = _LazyModule('astropy.units')
+astropy_time = _LazyModule('astropy.time')
+fits = _LazyModule('astropy.io.fits')
+leuschner_sim = _LazyModule('leuschner_sim')
+http_server = _LazyModule('http.server')
+shared_memory = _LazyModule('multiprocessing.shared_memory')
+resource_tracker = _LazyModule('multiprocessing.resource_tracker')
+
+DELAY_TIME = 0.1 # seconds
+POLL_TIME = 0.001 # seconds
+WAIT_MARGIN = 0.05 # fraction of a dump period
+PERIOD_WEIGHT = 0.2 # weight of the newest interval in the dump period estimate
+HOST = 'localhost'
+FPGFILE = 'fpga/ugradio_corrspec_2022-02-22_0905.fpg'
+STREAM_1 = 0
+STREAM_2 = 1
+LOGGER = 'spectrometer.log'
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_DATEFMT = '%m/%d/%Y %I:%M:%S %p'
+LOG_MAX_BYTES = 5*2**20 # rotate the log file at 5 MB
+LOG_BACKUPS = 3
+# Levels of the libraries' loggers, which are very chatty at DEBUG
+LIBRARY_LEVELS = {'casperfpga': logging.WARNING,
+                  'katcp': logging.WARNING,
+                  'tornado': logging.WARNING,
+                  'hera_corr_f': logging.INFO,
+                  'matplotlib': logging.WARNING}
+TRANSPORT = 'default'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'leuschner')
+ACC_LEN = 38150
+SPEC_PER_ACC = 8
+COORD_SYSTEMS = ('ga', 'eq')
+UNIX_EPOCH_JD = 2440587.5 # Julian date of 1970-01-01 00:00:00 UTC
+NCHAN = 1024
+ADC_RATE = 500e6 # Hz
+NBUFFERS = 8
+FITS_BLOCK = 2880 # bytes
+LAYOUTS = ('hdu', 'table')
+REDUCTIONS = ('mean', 'sum')
+# FITS formats of the spectra; 'int' stores the raw accumulator values with a TSCALn scale
+ENCODINGS = {'float64': 'D', 'float32': 'E', 'int': 'J'}
+# Formats of the 'int' encoding and the magnitude their values must stay below:
+# 32-bit (the BRAM word width, which holds a raw dump) or 64-bit for sums of dumps
+INT_LIMITS = {'J': 2.**31, 'K': 2.**63}
+COMPRESSIONS = (None, 'gzip')
+FPGA_TIME_TOL = 0.05 # median host latency above which the FPGA-derived times are not used [s]
+TIMES_NAME = 'TIMES' # EXTNAME of the per-integration timestamps
+GZIP_LEVEL = 6
+INIT_RETRIES = 2 # retries of a failed initialization stage
+INIT_BACKOFF = 0.5 # seconds before the first retry, doubled for each further one
+METRICS_PORT = 9105
+LATENCY_BUCKETS = (1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.) # seconds
+SHM_NAME = 'leuschner' # prefix of the shared-memory names, see shared_name
+SHM_SLOTS = 16 # dumps held in shared memory
+SHM_HEADER = 4096 # bytes of JSON layout at the start of the shared memory
+SHM_CONTROL = 64 # bytes of counters after the layout
+SHM_META = (('seq', np.int64), ('acc_cnt', np.int64), ('acc_cnt1', np.int64), ('gap', np.int64), 
+            ('desync', np.int64), ('unix', np.float64))
+SHM_KEYS = ('acc_cnt', 'acc_cnt1', 'gap', 'desync', 'unix')
+
+# Logging
+LOG = logging.getLogger('leuschner')
+_LISTENER = None
+
+def setup_logging(filename=LOGGER, level=logging.INFO, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUPS,
+                  library_levels=LIBRARY_LEVELS):
+    """
+    Send the spectrometer's log (the ''leuschner'' logger and the 
+    libraries in ''library_levels'') to a size-rotated file. Records are
+    put on a queue and written by a background listener thread, so 
+    logging never blocks the acquisition on file I/O. Calling it again 
+    replaces the previous configuration.
+
+    Inputs:
+    - filename: Log file.
+    - level: Level of the ''leuschner'' logger. DEBUG also enables the
+        per-integration debug messages of the acquisition loops.
+    - max_bytes, backup_count: Size at which the file is rotated and 
+        number of old files kept.
+    - library_levels: Dictionary of logger names and levels for the
+        libraries used by the spectrometer.
+    """
+    global _LISTENER
+    stop_logging()
+    handler = _log_file_handler(filename, max_bytes, backup_count)
+    log_queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+
+    LOG.setLevel(level)
+    LOG.addHandler(queue_handler)
+    for name, lib_level in library_levels.items():
+        lib_logger = logging.getLogger(name)
+        lib_logger.setLevel(lib_level)
+        lib_logger.addHandler(queue_handler)
+
+    _LISTENER = logging.handlers.QueueListener(log_queue, handler)
+    _LISTENER.queue_handler = queue_handler
+    _LISTENER.loggers = [LOG] + [logging.getLogger(name) for name in library_levels]
+    _LISTENER.files = set([os.path.abspath(filename)])
+    _LISTENER.start()
+
+
+def add_log_file(filename, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUPS):
+    """
+    Also write the spectrometer's log to ''filename'', next to the files
+    already configured, starting the logging with ''setup_logging'' if it
+    is not running yet. Adding a file twice has no effect.
+
+    Inputs:
+    - filename: Log file.
+    - max_bytes, backup_count: See ''setup_logging''.
+    """
+    if _LISTENER is None:
+        setup_logging(filename, max_bytes=max_bytes, backup_count=backup_count)
+        return
+    if os.path.abspath(filename) in _LISTENER.files:
+        return
+    _LISTENER.files.add(os.path.abspath(filename))
+    _LISTENER.handlers = _LISTENER.handlers + (_log_file_handler(filename, max_bytes, backup_count),)
+
+
+def _log_file_handler(filename, max_bytes, backup_count):
+    """
+    Size-rotated file handler in the spectrometer's log format.
+    """
+    handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+    return handler
+
+
+def stop_logging():
+    """
+    Flush and stop the background log listener started by 
+    ''setup_logging''.
+    """
+    global _LISTENER
+    if _LISTENER is None:
+        return
+    _LISTENER.stop()
+    for lib_logger in _LISTENER.loggers:
+        lib_logger.removeHandler(_LISTENER.queue_handler)
+    for handler in _LISTENER.handlers:
+        handler.close()
+    _LISTENER = None
+
+atexit.register(stop_logging)
+
+
+# Create metrics classes
+class Histogram(object):
+    """
+    Latency histogram with fixed buckets, in the form used by Prometheus
+    (cumulative counts of values <= each upper bound, plus their sum).
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0]*(len(self.buckets) + 1) # last one is +Inf
+        self.sum = 0.
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        Add one value to the histogram.
+        """
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """
+        Dictionary with the ''count'', ''sum'' and the cumulative counts of
+        the ''buckets'' as (upper bound, count) pairs.
+        """
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = np.cumsum(counts).tolist()
+        return {'count': count, 'sum': total, 
+                'buckets': list(zip(self.buckets + (float('inf'),), cumulative))}
+
+
+class Metrics(object):
+    """
+    Counters and latency histograms of a Spectrometer's acquisitions. 
+    Updating them costs a clock read and a short lock, so they are always
+    on. Read them with ''snapshot'' or in the Prometheus text format with
+    ''prometheus'', which ''serve'' exposes over HTTP.
+    """
+    COUNTERS = {'dumps_seen': "Accumulation dumps stored",
+                'dumps_missed': "Accumulation dumps skipped or dropped",
+                'desyncs': "Integrations with desynced correlators",
+                'bytes_written': "Bytes written to FITS files, including header rewrites"}
+    HISTOGRAMS = {'wait_seconds': "Time blocked in wait_for_cnt",
+                  'bram_read_seconds': "Time to read a correlator BRAM",
+                  'fits_build_seconds': "Time to build the FITS records of an integration",
+                  'disk_write_seconds': "Time to write buffered integrations to disk"}
+
+    def __init__(self, buckets=LATENCY_BUCKETS, prefix='leuschner'):
+        """
+        Inputs:
+        - buckets: Upper bounds of the latency histogram buckets [s].
+        - prefix: Prefix of the Prometheus metric names.
+        """
+        self.buckets = buckets
+        self.prefix = prefix
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.histograms = {} # (name, labels): Histogram
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        """
+        Increase a counter.
+        """
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name, value, **labels):
+        """
+        Add a latency [s] to a histogram, e.g. 
+        ''observe('bram_read_seconds', dt, corr='corr_0')''.
+        """
+        if name not in self.HISTOGRAMS:
+            raise KeyError("Unknown histogram: " + name)
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram(self.buckets))
+        histogram.observe(value)
+
+    def snapshot(self):
+        """
+        Current values of all metrics.
+        Returns:
+        - Dictionary with the ''counters'' and the ''histograms'', which 
+          map each name to a list of dictionaries with the ''labels'' and
+          the values of ''Histogram.snapshot''.
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = list(self.histograms.items())
+        snapshot = {'counters': counters, 'histograms': {}}
+        for (name, labels), histogram in sorted(histograms, key=lambda item: item[0]):
+            values = histogram.snapshot()
+            values['labels'] = dict(labels)
+            snapshot['histograms'].setdefault(name, []).append(values)
+        return snapshot
+
+    def prometheus(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name in sorted(self.COUNTERS):
+            metric = '%s_%s_total' % (self.prefix, name)
+            lines.append('# HELP %s %s.' % (metric, self.COUNTERS[name]))
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %d' % (metric, snapshot['counters'][name]))
+        for name in sorted(snapshot['histograms']):
+            metric = '%s_%s' % (self.prefix, name)
+            lines.append('# HELP %s %s.' % (metric, self.HISTOGRAMS[name]))
+            lines.append('# TYPE %s histogram' % metric)
+            for values in snapshot['histograms'][name]:
+                labels = ['%s="%s"' % item for item in sorted(values['labels'].items())]
+                for le, count in values['buckets']:
+                    bound = '+Inf' if le == float('inf') else repr(le)
+                    lines.append('%s_bucket{%s} %d' % (metric, ','.join(labels + ['le="%s"' % bound]), count))
+                suffix = '{%s}' % ','.join(labels) if labels else ''
+                lines.append('%s_sum%s %r' % (metric, suffix, values['sum']))
+                lines.append('%s_count%s %d' % (metric, suffix, values['count']))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=METRICS_PORT, host='127.0.0.1'):
+        """
+        Serve ''prometheus'' at http://host:port/metrics from a daemon 
+        thread.
+
+        Inputs:
+        - port: TCP port. 0 picks a free one.
+        - host: Interface to listen on. Defaults to the local host only.
+        Returns:
+        - The HTTP server; its port is ''server.server_address[1]'' and
+          ''server.shutdown()'' stops it.
+        """
+        metrics = self
+
+        class Handler(http_server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                LOG.debug('Metrics request: ' + format % args)
+
+        server = http_server.ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, name='leuschner-metrics', daemon=True)
+        thread.start()
+        LOG.info('Serving metrics at http://%s:%d/metrics' % server.server_address[:2])
+        return server
+
+
+# Create streaming FITS writer
+class FitsStreamWriter(object):
+    """
+    Writes a FITS file incrementally so that each integration lands on
+    disk as it is read instead of being held in an in-memory HDUList.
+    The primary HDU is written when the file is opened and the file is
+    valid and readable after every flush, even if the run is
+    interrupted.
+
+    Spectra are stored as float64 by default. With ''encoding'' 'float32'
+    they take half the space, and with 'int' the raw integer accumulator
+    values are stored as 32-bit integers (64-bit if they may exceed that
+    range, e.g. sums of many dumps), with the normalization in the TSCALn
+    keyword of each column, which astropy applies on reading. The 
+    finished file can also be gzip compressed.
+
+    With ''checkpoint_every'', the file is made durable (fsync) at 
+    regular intervals and a small sidecar manifest (''filename''.ckpt) 
+    records how much of it is complete: the integrations and dumps 
+    written, the last acc_cnt and the file size. The manifest is replaced
+    atomically, so it always describes data that is on disk. If the run
+    is interrupted, a writer opened with ''resume'' drops whatever was 
+    written after the last checkpoint and appends to the file from there.
+
+    Every integration written with a ''unix'' time (the host clock when
+    the dump was seen) is timestamped when the file is closed: a last 
+    ''TIMES'' table holds one row per integration with ''acc_cnt'', 
+    ''unix'', ''fpga_unix'' (see ''fpga_times''), ''jd'' and ''lst'' 
+    (see ''observation_times''). The JD and LST are computed for the 
+    whole file at once, from the FPGA-derived times where available, 
+    unless they are off the host times by more than ''FPGA_TIME_TOL'' 
+    (e.g. a counter glitch); the FPGATIME keyword of the table records 
+    which times were used. The 'hdu' layout only gets the table on request (''times''), since 
+    its readers expect every extension to be an integration.
+
+    Two layouts are supported:
+    - 'hdu': one BinTableHDU per integration with one row per channel
+        (the original layout). Per-integration metadata is stored as
+        header keywords of each table.
+    - 'table': a single BinTableHDU with one row per integration. Each
+        spectrum is a fixed-width vector column (e.g. ''1024D'') and
+        per-integration metadata are scalar columns, so the whole
+        dataset can be sliced or memory-mapped in one call.
+    """
+
+    def __init__(self, filename, primaryhdu, name='CORR_DATA', layout='hdu', flush_every=1, metrics=None,
+                 encoding='float64', scale=1., compress=None, checkpoint_every=None, checkpoint_state=None,
+                 resume=False, integration_time=None, location=None, times=None, max_units=None):
+        """
+        Open the output file and write the primary HDU.
+
+        Inputs:
+        - filename: Name of the output FITS file. Overwritten if it exists,
+            unless ''resume'' is True.
+        - primaryhdu: PrimaryHDU containing the observation header. Not 
+            used when resuming.
+        - name: EXTNAME of the data table(s).
+        - layout: Output layout, either 'hdu' or 'table'.
+        - flush_every: Number of integrations buffered before they are
+            written to disk.
+        - metrics: Optional ''Metrics'' recording the time spent building
+            records and writing them, and the bytes written.
+        - encoding: Storage of the spectra, 'float64', 'float32' or 'int'.
+        - scale: For the 'int' encoding, the value of one accumulator unit
+            (e.g. the normalization 1/(acc_len*spec_per_acc)). Spectra are
+            divided by it and rounded before they are stored. Variance 
+            columns (''*_var'') are stored as float32 instead.
+        - compress: None, or 'gzip' to compress the file to 
+            ''filename''.gz when it is closed.
+        - checkpoint_every: If set, make a checkpoint at the first flush
+            after every this many integrations.
+        - checkpoint_state: Optional function returning a JSON-serializable
+            dictionary stored in each manifest as ''state'', e.g. the dump
+            accounting of the acquisition.
+        - resume: If True, append to ''filename'' from its last checkpoint
+            (see ''read_manifest''). The layout and encoding must be those
+            of the file.
+        - integration_time: Nominal time between dumps [s]. If given, 
+            the dump times are also derived from acc_cnt (see 
+            ''fpga_times''); without it, only the host times are used.
+        - location: Observatory (longitude [deg], latitude [deg], altitude
+            [m]) for the LST, or a function returning it (or None), called 
+            when the file is closed (e.g. ''observatory_location''). 
+            Without it, no JD or LST is computed.
+        - times: Whether to append the TIMES table when the file is 
+            closed. Default None does so for the 'table' layout only.
+        - max_units: For the 'int' encoding, the largest magnitude of the
+            spectra in accumulator units. The spectra are stored as 32-bit
+            integers, or as 64-bit ones if it can exceed their range. 
+            Default None is one raw dump, which fits 32 bits.
+        """
+        if layout not in LAYOUTS:
+            raise ValueError("Invalid layout supplied: " + str(layout))
+        if encoding not in ENCODINGS:
+            raise ValueError("Invalid encoding supplied: " + str(encoding))
+        if compress not in COMPRESSIONS:
+            raise ValueError("Invalid compression supplied: " + str(compress))
+        if flush_every < 1:
+            raise ValueError("flush_every must be at least 1: " + str(flush_every))
+        if checkpoint_every is not None and checkpoint_every < 1:
+            raise ValueError("checkpoint_every must be at least 1: " + str(checkpoint_every))
+        self.filename = filename
+        self.name = name
+        self.layout = layout
+        self.flush_every = flush_every
+        self.metrics = metrics
+        self.encoding = encoding
+        self.scale = scale
+        self.compress = compress
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_state = checkpoint_state
+        self.manifest_file = filename + '.ckpt'
+        self.nwritten = 0
+        self.ndumps = 0 # dumps contained in the integrations written
+        self.last_cnt = None
+        self.resumes = 0
+        self.integration_time = integration_time
+        self.location = location
+        self.times = layout == 'table' if times is None else times
+        self.int_format = 'J' if max_units is None or max_units < INT_LIMITS['J'] else 'K'
+        self._checkpointed = 0
+        self._times_cnt = [] # acc_cnt and unix of every integration, for the TIMES table
+        self._times_unix = []
+
+        self._table_header = None
+        self._dtype = None
+        self._pending = []
+        self._data_end = None
+        if resume:
+            self._resume()
+            return
+
+        self._header = primaryhdu.header.copy()
+        self._header['EXTEND'] = True
+        self._header['LAYOUT'] = (layout, "Layout of the data tables")
+        self._header['ENCODING'] = (encoding, "Storage of the spectra")
+        if encoding == 'int':
+            self._header['INTFMT'] = (self.int_format, "FITS format of the integer spectra")
+
+        self._fileobj = open(filename, 'wb')
+        self._write(self._header.tostring().encode('ascii'))
+        self._fileobj.flush()
+        self._table_offset = self._fileobj.tell()
+        if checkpoint_every is not None:
+            self.checkpoint()
+
+    def _resume(self):
+        """
+        Reopen the file at its last checkpoint.
+        """
+        manifest = read_manifest(self.filename)
+        if manifest is None:
+            raise IOError("No checkpoint to resume: " + self.filename)
+        for key in ('layout', 'encoding'):
+            if manifest[key] != getattr(self, key):
+                raise ValueError("Cannot resume %s with %s %s, it was written with %s." % (
+                    self.filename, key, getattr(self, key), manifest[key]))
+        self._fileobj = open(self.filename, 'r+b')
+        # Drop anything written after the checkpoint
+        self._fileobj.truncate(manifest['nbytes'])
+        self._header = fits.Header.fromfile(self._fileobj)
+        self._table_offset = self._fileobj.tell()
+        self.nwritten = self._checkpointed = manifest['nwritten']
+        self.ndumps = manifest['ndumps']
+        self.last_cnt = manifest['last_cnt']
+        self.resumes = manifest.get('resumes', 0) + 1
+        self.int_format = self._header.get('INTFMT', self.int_format)
+        if 'NRESUME' in self._header:
+            self._header['NRESUME'] = self.resumes
+        if self.layout == 'table' and self.nwritten:
+            # The table header may count rows written after the checkpoint
+            self._table_header = fits.Header.fromfile(self._fileobj)
+            self._table_header['NAXIS2'] = self.nwritten
+            self._fileobj.seek(self._table_offset)
+            self._write(self._table_header.tostring().encode('ascii'))
+            self._data_end = manifest['data_end']
+        self._fileobj.seek(0, os.SEEK_END)
+        self._fileobj.flush()
+        if self.times and self.nwritten:
+            meta = SpectrumReader(self.filename, cache=False).meta
+            if 'unix' in meta:
+                self._times_unix = list(meta['unix'])
+                self._times_cnt = list(meta['acc_cnt']) if 'acc_cnt' in meta else [-1]*self.nwritten
+        LOG.info('Resuming %s after %d integrations (acc_cnt %s).' % (self.filename, self.nwritten, self.last_cnt))
+
+    def _write(self, data):
+        """
+        Write bytes at the current position of the file.
+        """
+        self._fileobj.write(data)
+        if self.metrics is not None:
+            self.metrics.inc('bytes_written', len(data))
+
+    def _pad(self, nbytes):
+        """
+        Number of bytes needed to pad ''nbytes'' to a full FITS block.
+        """
+        return -nbytes % FITS_BLOCK
+
+    def _data_format(self, name):
+        """
+        FITS column format code and scale of a spectrum column.
+        """
+        if self.encoding == 'int':
+            if name.endswith('_var'):
+                return 'E', None
+            return self.int_format, self.scale
+        return ENCODINGS[self.encoding], None
+
+    def _meta_format(self, value):
+        """
+        FITS column format for a scalar metadata value.
+        """
+        if isinstance(value, (int, np.integer)):
+            return 'K'
+        return 'D'
+
+    def _make_table(self, data, meta):
+        """
+        Build the table header and on-disk record layout from the first
+        integration. Every following integration has the same columns
+        and shapes, so the header is reused.
+        """
+        formats = [self._data_format(name) for name in data]
+        if self.layout == 'hdu':
+            cols = [fits.Column(name=name, format=fmt, array=np.zeros(len(array))) 
+                    for (name, array), (fmt, _) in zip(data.items(), formats)]
+            bintablehdu = fits.BinTableHDU.from_columns(cols, name=self.name)
+            self._set_scales(bintablehdu.header, formats)
+            for key, value in meta.items():
+                bintablehdu.header[key.upper()] = value
+            self._table_header = bintablehdu.header.tostring().encode('ascii')
+            self._meta_cards = dict((key, bintablehdu.header.index(key.upper())*fits.Card.length) 
+                                    for key in meta)
+            self._nrows = len(bintablehdu.data)
+        elif self.layout == 'table':
+            cols = [fits.Column(name=name, format='%d%s' % (len(array), fmt)) 
+                    for (name, array), (fmt, _) in zip(data.items(), formats)]
+            cols += [fits.Column(name=key, format=self._meta_format(value)) for key, value in meta.items()]
+            bintablehdu = fits.BinTableHDU.from_columns(cols, name=self.name, nrows=0)
+            self._set_scales(bintablehdu.header, formats)
+            self._table_header = bintablehdu.header
+            if self._data_end is None: # set when resuming
+                self._data_end = self._table_offset + len(self._table_header.tostring())
+            self._nrows = 1
+        # FITS tables are big-endian on disk
+        self._dtype = bintablehdu.data.dtype.newbyteorder('>')
+        self._inverse = dict((name, 1./scale) for name, (_, scale) in zip(data, formats) if scale is not None)
+
+    def _set_scales(self, header, formats):
+        """
+        Record the scale of integer columns as TSCALn keywords.
+        """
+        for i, (fmt, scale) in enumerate(formats):
+            if scale is not None:
+                header.insert('TFORM%d' % (i + 1), ('TSCAL%d' % (i + 1), scale, "Value of one accumulator unit"), 
+                              after=True)
+
+    def write(self, data, meta=None):
+        """
+        Append one integration.
+
+        Inputs:
+        - data: Dictionary mapping column names to equal-length arrays.
+        - meta: Optional dictionary of per-integration scalar values
+            (e.g. ''acc_cnt'', ''unix''). Stored as header keywords in
+            the 'hdu' layout and as columns in the 'table' layout.
+        """
+        if self._fileobj is None:
+            raise IOError("Cannot write to closed file: " + self.filename)
+        start = time.perf_counter()
+        if meta is None:
+            meta = {}
+        if self._dtype is None:
+            self._make_table(data, meta)
+        records = np.empty(self._nrows, dtype=self._dtype)
+        for name, array in data.items():
+            if name in self._inverse:
+                values = np.rint(np.multiply(array, self._inverse[name]))
+                if not np.all(np.abs(values) < INT_LIMITS[self.int_format]): # also false for NaN
+                    raise ValueError("Column %s does not fit the 'int' encoding (max |value| %g units)." % (
+                        name, np.nanmax(np.abs(values))))
+                records[name] = values
+            else:
+                records[name] = array
+        if self.layout == 'hdu':
+            header = bytearray(self._table_header)
+            for key, value in meta.items():
+                offset = self._meta_cards[key]
+                header[offset:offset+fits.Card.length] = fits.Card(key.upper(), value).image.encode('ascii')
+            nbytes = records.nbytes
+            self._pending.append(bytes(header) + records.tobytes() + bytes(self._pad(nbytes)))
+        elif self.layout == 'table':
+            for key, value in meta.items():
+                records[key] = value
+            self._pending.append(records.tobytes())
+        self.nwritten += 1
+        self.ndumps += meta.get('ndumps', 1)
+        if 'acc_cnt' in meta:
+            self.last_cnt = meta['acc_cnt']
+        if self.times and meta.get('unix') is not None:
+            self._times_unix.append(meta['unix'])
+            self._times_cnt.append(meta.get('acc_cnt', -1))
+        if self.metrics is not None:
+            self.metrics.observe('fits_build_seconds', time.perf_counter() - start)
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Write any buffered integrations to disk. In the 'table' layout the
+        rows are appended after the existing ones, the padding is
+        rewritten and NAXIS2 is updated so the file stays valid.
+        """
+        start = time.perf_counter()
+        pending = self._pending
+        if pending and self.layout == 'hdu':
+            self._write(b''.join(pending))
+        elif pending and self.layout == 'table':
+            rows = b''.join(pending)
+            self._fileobj.seek(self._data_end)
+            self._write(rows)
+            self._data_end += len(rows)
+            nbytes = self._data_end - self._table_offset - len(self._table_header.tostring())
+            self._write(bytes(self._pad(nbytes)))
+            self._table_header['NAXIS2'] = self.nwritten
+            self._fileobj.seek(self._table_offset)
+            self._write(self._table_header.tostring().encode('ascii'))
+            self._fileobj.seek(0, os.SEEK_END)
+        self._pending = []
+        self._fileobj.flush()
+        if pending and self.metrics is not None:
+            self.metrics.observe('disk_write_seconds', time.perf_counter() - start)
+        if self.checkpoint_every is not None and self.nwritten - self._checkpointed >= self.checkpoint_every:
+            self._checkpoint()
+
+    def checkpoint(self):
+        """
+        Flush the buffered integrations and make a checkpoint.
+        """
+        self.flush()
+        if self._checkpointed != self.nwritten or not os.path.exists(self.manifest_file):
+            self._checkpoint()
+
+    def _checkpoint(self):
+        """
+        Make the flushed data durable, then atomically replace the 
+        manifest describing it.
+        """
+        os.fsync(self._fileobj.fileno())
+        manifest = {'filename': self.filename, 'layout': self.layout, 'encoding': self.encoding,
+                    'nwritten': self.nwritten, 'ndumps': self.ndumps, 'last_cnt': self.last_cnt,
+                    'nbytes': os.fstat(self._fileobj.fileno()).st_size, 'data_end': self._data_end,
+                    'resumes': self.resumes, 'unix': time.time()}
+        if self.checkpoint_state is not None:
+            manifest['state'] = self.checkpoint_state()
+        tmp = self.manifest_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.manifest_file)
+        self._checkpointed = self.nwritten
+
+    def update_header(self, key, value):
+        """
+        Change a keyword of the primary header. The header is rewritten 
+        in place on ''close'', so the keyword must already exist (e.g. as 
+        a placeholder) to keep the header size unchanged.
+        """
+        if key not in self._header:
+            raise KeyError("Keyword not in primary header: " + key)
+        self._header[key] = value
+
+    def close(self, complete=True):
+        """
+        Flush remaining integrations, record the number of spectra
+        actually written in the primary header and close the file.
+
+        Inputs:
+        - complete: Whether the acquisition is complete. If not, e.g. it 
+            failed, a last checkpoint is made and kept for resuming, and 
+            the file is not compressed.
+        """
+        if self._fileobj is None:
+            return
+        self.flush()
+        if self.checkpoint_every is not None and not complete:
+            self.checkpoint()
+        try:
+            # After the checkpoint: a resumed file is timestamped again when closed
+            self._write_times()
+        finally:
+            # Whatever happens to the timestamps, the header is completed
+            try:
+                if 'NSPEC' in self._header:
+                    self._header['NSPEC'] = self.nwritten
+                self._fileobj.seek(0)
+                self._write(self._header.tostring().encode('ascii'))
+            finally:
+                self._fileobj.close()
+                self._fileobj = None
+        if self.checkpoint_every is not None and not complete:
+            return
+        if self.checkpoint_every is not None and os.path.exists(self.manifest_file):
+            # The file is complete, there is nothing left to resume
+            os.remove(self.manifest_file)
+        if self.compress == 'gzip':
+            self._gzip()
+
+    def _write_times(self):
+        """
+        Append the TIMES table, if every integration has a unix time.
+        """
+        nrows = len(self._times_unix)
+        if nrows == 0 or nrows != self.nwritten:
+            return
+        start = time.perf_counter()
+        acc_cnt = np.array(self._times_cnt, dtype=np.int64)
+        unix = np.array(self._times_unix, dtype=float)
+        columns = [('acc_cnt', 'K', None, acc_cnt), ('unix', 'D', 's', unix)]
+        fpga_ok = None
+        if self.integration_time is not None:
+            fpga_unix, period = fpga_times(acc_cnt, unix)
+            columns.append(('fpga_unix', 'D', 's', fpga_unix))
+            # The host sees the dumps late by its latency, which is small
+            # unless the fit does not describe the dumps
+            latency = (unix - fpga_unix)[np.isfinite(fpga_unix)]
+            median = np.median(latency) if len(latency) else 0.
+            fpga_ok = bool(median < FPGA_TIME_TOL)
+            if fpga_ok:
+                # Host time where the acc_cnt is unknown
+                unix = np.where(np.isnan(fpga_unix), unix, fpga_unix)
+            else:
+                LOG.warning('FPGA-derived times of %s off the host times by %.3f s (median), using the host '
+                            'times for the JD and LST.' % (self.filename, median))
+        location = self.location() if callable(self.location) else self.location
+        if location is not None:
+            jd, lst = observation_times(unix, location)
+            columns += [('jd', 'D', 'd', jd), ('lst', 'D', 'h', lst)]
+        bintablehdu = fits.BinTableHDU.from_columns([fits.Column(name=name, format=fmt, unit=unit) 
+                                                     for name, fmt, unit, _ in columns], name=TIMES_NAME, nrows=0)
+        header = bintablehdu.header
+        header['NAXIS2'] = nrows
+        if self.integration_time is not None:
+            header['INTTIME'] = (self.integration_time, "Nominal time between dumps [s]")
+            if np.isfinite(period):
+                header['DUMPPER'] = (period, "Fitted time between dumps [s]")
+            header['TIMELAT'] = (median, "Median host latency of the dumps [s]")
+            header['FPGATIME'] = (fpga_ok, "JD and LST from the FPGA-derived times")
+        if location is not None:
+            lon, lat, alt = location
+            header['LON'] = (lon, "Observatory longitude [deg]")
+            header['LAT'] = (lat, "Observatory latitude [deg]")
+            header['ALT'] = (alt, "Observatory altitude [m]")
+        records = np.empty(nrows, dtype=bintablehdu.data.dtype.newbyteorder('>'))
+        for name, _, _, values in columns:
+            records[name] = values
+        self._fileobj.seek(0, os.SEEK_END)
+        self._write(header.tostring().encode('ascii') + records.tobytes() + bytes(self._pad(records.nbytes)))
+        LOG.info('Timestamped %d integrations of %s in %.2f s.' % (nrows, self.filename, time.perf_counter() - start))
+
+    def _gzip(self):
+        """
+        Compress the closed file to ''filename''.gz and remove the original.
+        """
+        with open(self.filename, 'rb') as f_in:
+            with gzip.open(self.filename + '.gz', 'wb', compresslevel=GZIP_LEVEL) as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        os.remove(self.filename)
+        self.filename += '.gz'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_manifest(filename):
+    """
+    Manifest of the last checkpoint of a FITS file being written by a
+    ''FitsStreamWriter''.
+    Returns:
+    - Dictionary with the ''layout'' and ''encoding'' of the file, the 
+      integrations (''nwritten'') and dumps (''ndumps'') written, the 
+      ''last_cnt'' written, the size of the complete part (''nbytes''), 
+      the number of ''resumes'', the time of the checkpoint (''unix'') 
+      and, if recorded, the acquisition ''state''; or None if the file 
+      has no checkpoint.
+    """
+    try:
+        with open(filename + '.ckpt') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+# Create dump timestamps
+def observatory_location():
+    """
+    Location of the observatory, from ''ugradio.leo''.
+    Returns:
+    - (longitude [deg], latitude [deg], altitude [m]), or None if ugradio
+      is not installed (e.g. offline or on the simulated SNAP).
+    """
+    try:
+        leo = ugradio.leo
+    except ImportError as e:
+        LOG.warning('Observatory location unknown, no JD or LST recorded: %s' % e)
+        return None
+    return (leo.lon, leo.lat, leo.alt)
+
+
+def fpga_times(acc_cnt, unix):
+    """
+    Dump times derived from the accumulation counter: a line, dump time =
+    offset + acc_cnt*period, fitted to the host times at which the dumps
+    were seen. The host sees a dump late by the polling and readout 
+    latency, never early, so the line is the lower envelope of the 
+    (acc_cnt, unix) points: the edge of their lower convex hull that the
+    promptly seen dumps are closest to (smallest lower quartile of the
+    distances), so that dumps seen late, e.g. while the polling settles
+    on the dump cadence, do not tilt it. Both the period and the offset are
+    fitted, so the times do not depend on the nominal integration time 
+    being exact. The line is fitted per run of increasing acc_cnt, since
+    the counter restarts when the SNAP is initialized.
+
+    Inputs:
+    - acc_cnt: Array of the acc_cnt of the dumps (negative if unknown).
+    - unix: Array of the host times at which they were seen [s].
+    Returns:
+    - Array of the dump times [s], NaN where acc_cnt is unknown. A run of
+      a single dump keeps its host time.
+    - Period fitted to the longest run [s], NaN if no run has two dumps.
+    """
+    acc_cnt = np.asarray(acc_cnt, dtype=np.int64)
+    unix = np.asarray(unix, dtype=float)
+    times = np.full(len(unix), np.nan)
+    period = np.nan
+    known = np.flatnonzero((acc_cnt >= 0) & np.isfinite(unix))
+    if len(known) == 0:
+        return times, period
+    # Split where the counter restarts
+    restarts = np.flatnonzero(np.diff(acc_cnt[known]) <= 0) + 1
+    longest = 1
+    for run in np.split(known, restarts):
+        if len(run) == 1:
+            times[run] = unix[run]
+            continue
+        # Relative to the first dump, for precision
+        x = (acc_cnt[run] - acc_cnt[run[0]]).astype(float)
+        y = unix[run] - unix[run[0]]
+        slope, offset = _lower_envelope(x, y)
+        times[run] = unix[run[0]] + offset + slope*x
+        if len(run) > longest:
+            longest, period = len(run), slope
+    return times, period
+
+
+def _lower_envelope(x, y):
+    """
+    Line below all the points (''x'' increasing, ''y''), closest to the
+    lowest ones: the edge of their lower convex hull with the smallest
+    lower quartile of the distances to the points.
+    Returns:
+    - Slope and offset of the line.
+    """
+    hull = []
+    for i in range(len(x)):
+        while len(hull) >= 2:
+            a, b = hull[-2], hull[-1]
+            if (x[b] - x[a])*(y[i] - y[a]) - (y[b] - y[a])*(x[i] - x[a]) > 0:
+                break
+            hull.pop()
+        hull.append(i)
+    hx, hy = x[hull], y[hull]
+    slopes = np.diff(hy)/np.diff(hx)
+    offsets = hy[:-1] - slopes*hx[:-1]
+    best, distance = 0, np.inf
+    for k in range(len(slopes)):
+        d = np.percentile(y - offsets[k] - slopes[k]*x, 25)
+        if d < distance:
+            best, distance = k, d
+    return slopes[best], offsets[best]
+
+
+def observation_times(unix, location):
+    """
+    Julian dates and local sidereal times of an array of times, converted
+    in one vectorized astropy call.
+
+    Inputs:
+    - unix: Array of unix times [s].
+    - location: Observatory (longitude [deg], latitude [deg], altitude
+        [m]).
+    Returns:
+    - Arrays of the JD and of the apparent LST [hours]. Both are NaN where
+      the time is not finite, and the LST is NaN if it could not be 
+      computed (e.g. no Earth orientation data).
+    """
+    unix = np.asarray(unix, dtype=float)
+    jd = np.full(len(unix), np.nan)
+    lst = np.full(len(unix), np.nan)
+    finite = np.isfinite(unix)
+    if not finite.any():
+        return jd, lst
+    t = astropy_time.Time(unix[finite], format='unix', location=location)
+    jd[finite] = t.jd
+    try:
+        lst[finite] = t.sidereal_time('apparent').hour
+    except Exception as e:
+        LOG.warning('Could not compute the LST: %s' % e)
+    return jd, lst
+
+
+# Create FITS reader
+class SpectrumReader(object):
+    """
+    Random access to the spectra of a FITS file written by the 
+    Spectrometer, in either layout, without opening every extension 
+    with astropy. 
+
+    The byte offsets of the data tables and the per-integration metadata
+    are indexed once and cached next to the file (''filename''.idx). The
+    index is rebuilt when the file changes, so files that are still being
+    written can be read as well. Spectra are returned as read-only views
+    of a memory map of the file, so only the requested integrations are 
+    read from disk. Columns stored as scaled integers (the 'int' encoding)
+    are returned scaled, which makes a copy of the requested slice.
+
+        reader = SpectrumReader('obs.fits')
+        reader.header['RA'], len(reader), reader.products
+        spectra = reader.read(['auto0_real'], start=100, stop=200)
+        reader.meta['acc_cnt']
+    """
+    # FITS binary table format codes
+    FORMATS = {'L': 'i1', 'B': 'u1', 'I': '>i2', 'J': '>i4', 'K': '>i8', 'E': '>f4', 'D': '>f8', 
+               'C': '>c8', 'M': '>c16', 'A': 'S1'}
+    STRUCTURAL = ('XTENSION', 'BITPIX', 'NAXIS', 'PCOUNT', 'GCOUNT', 'TFIELDS', 'EXTNAME', 'END',
+                  'TTYPE', 'TFORM', 'TSCAL', 'TZERO', 'TUNIT', 'TDIM', 'TNULL', 'TDISP')
+
+    def __init__(self, filename, cache=True):
+        """
+        Inputs:
+        - filename: FITS file written by the Spectrometer.
+        - cache: If True (default), load the index from and save it to 
+            ''filename''.idx.
+        """
+        if filename.endswith('.gz'):
+            raise IOError("Cannot memory-map a compressed file, decompress it first: " + filename)
+        self.filename = filename
+        self.index_file = filename + '.idx'
+        self._header = None
+        self._mmap = None
+        index = self._load_index() if cache else None
+        if index is None:
+            index = self._build_index()
+            if cache:
+                self._save_index(index)
+        self._index = index
+        self.layout = index['layout']
+        self.offsets = np.array(index['offsets'], dtype=np.int64)
+        self.columns = index['columns'] # [(name, dtype, repeat, scale, zero)]
+        self.dtype = self._dtype(self.columns)
+        self.nrows = index['nrows']
+        if self.layout == 'table':
+            # Per-integration metadata are the scalar columns
+            records = self._records(0, self.nrows, 1)
+            self.meta = dict((name.lower(), records[name]) for name, _, repeat, _, _ in self.columns if repeat == 1)
+        else:
+            self.meta = dict((key, np.array(values)) for key, values in index['meta'].items())
+
+    def _dtype(self, columns):
+        """
+        Record dtype of a table from its (name, dtype, repeat, scale, zero)
+        columns.
+        """
+        return np.dtype([(name, dtype) if repeat == 1 else (name, dtype, (repeat,)) 
+                         for name, dtype, repeat, _, _ in columns])
+
+    def _stat(self):
+        stat = os.stat(self.filename)
+        return [stat.st_size, stat.st_mtime]
+
+    def _load_index(self):
+        """
+        Load the cached index, or None if it is missing or out of date.
+        """
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if index.get('stat') != self._stat():
+            return None
+        return index
+
+    def _save_index(self, index):
+        try:
+            with open(self.index_file, 'w') as f:
+                json.dump(index, f)
+        except IOError as e:
+            LOG.warning('Could not cache the index of %s: %s' % (self.filename, e))
+
+    def _read_header(self, f):
+        """
+        Read the header at the current position of ''f''.
+        Returns:
+        - List of 80 character cards up to END, or None at the end of 
+          the file.
+        """
+        cards = []
+        while True:
+            block = f.read(FITS_BLOCK)
+            if len(block) < FITS_BLOCK:
+                return None
+            block = block.decode('ascii')
+            for i in range(0, FITS_BLOCK, 80):
+                card = block[i:i+80]
+                if card[:8].rstrip() == 'END':
+                    return cards
+                cards.append(card)
+
+    def _card_value(self, card):
+        return fits.Card.fromstring(card).value
+
+    def _columns(self, cards):
+        """
+        Column names, on-disk dtypes and scales of a table header.
+        """
+        values = dict((card[:8].rstrip(), card) for card in cards)
+        columns = []
+        for i in range(1, int(self._card_value(values['TFIELDS'])) + 1):
+            name = self._card_value(values['TTYPE%d' % i])
+            tform = self._card_value(values['TFORM%d' % i]).strip()
+            repeat, code = tform[:-1], tform[-1]
+            repeat = int(repeat) if repeat else 1
+            dtype = self.FORMATS[code]
+            if code == 'A':
+                dtype, repeat = 'S%d' % repeat, 1
+            scale = self._card_value(values['TSCAL%d' % i]) if 'TSCAL%d' % i in values else None
+            zero = self._card_value(values['TZERO%d' % i]) if 'TZERO%d' % i in values else None
+            columns.append((name, dtype, repeat, scale, zero))
+        return columns
+
+    def _build_index(self):
+        """
+        Walk the headers of the file and record the layout, the columns,
+        the data offset of every table, the per-integration metadata and
+        the location of the TIMES table.
+        """
+        size = os.path.getsize(self.filename)
+        index = {'stat': self._stat(), 'offsets': [], 'meta': {}, 'columns': None, 'nrows': 0}
+        with open(self.filename, 'rb') as f:
+            cards = self._read_header(f)
+            primary = dict((card[:8].rstrip(), card) for card in cards)
+            index['layout'] = self._card_value(primary['LAYOUT']) if 'LAYOUT' in primary else 'hdu'
+            while True:
+                cards = self._read_header(f)
+                if cards is None:
+                    break
+                offset = f.tell()
+                values = dict((card[:8].rstrip(), card) for card in cards)
+                naxis1 = int(self._card_value(values['NAXIS1']))
+                naxis2 = int(self._card_value(values['NAXIS2']))
+                pcount = int(self._card_value(values['PCOUNT'])) if 'PCOUNT' in values else 0
+                nbytes = naxis1*naxis2 + pcount
+                if offset + naxis1*naxis2 > size:
+                    break # integration still being written
+                if 'EXTNAME' in values and self._card_value(values['EXTNAME']) == TIMES_NAME:
+                    index['times'] = {'offset': offset, 'columns': self._columns(cards), 'nrows': naxis2}
+                    break
+                if index['columns'] is None:
+                    index['columns'] = self._columns(cards)
+                    index['nrows'] = naxis2
+                if index['layout'] == 'table':
+                    index['offsets'] = [offset]
+                    index['nrows'] = naxis2
+                    f.seek(offset + nbytes + (-nbytes % FITS_BLOCK))
+                    if f.read(8) != b'XTENSION':
+                        break # no TIMES table (yet)
+                    f.seek(-8, os.SEEK_CUR)
+                    continue
+                index['offsets'].append(offset)
+                # Per-integration metadata are the non-structural keywords
+                for card in cards:
+                    key = card[:8].rstrip()
+                    if card[8:10] != '= ' or key.rstrip('0123456789') in self.STRUCTURAL:
+                        continue
+                    index['meta'].setdefault(key.lower(), []).append(self._card_value(card))
+                f.seek(offset + nbytes + (-nbytes % FITS_BLOCK))
+        if index['columns'] is None:
+            index['columns'] = []
+        return index
+
+    @property
+    def header(self):
+        """
+        Primary header of the file (observation and spectrometer 
+        metadata), read on first use.
+        """
+        if self._header is None:
+            with open(self.filename, 'rb') as f:
+                self._header = fits.Header.fromstring(''.join(self._read_header(f)) + 'END'.ljust(80))
+        return self._header
+
+    @property
+    def products(self):
+        """
+        Names of the spectrum columns.
+        """
+        if self.layout == 'table':
+            return [name for name, _, repeat, _, _ in self.columns if repeat > 1]
+        return [name for name, _, _, _, _ in self.columns]
+
+    @property
+    def times(self):
+        """
+        Per-integration timestamps of the TIMES table written when the file
+        was closed (see ''FitsStreamWriter''): dictionary of the arrays 
+        ''acc_cnt'', ''unix'' and, if recorded, ''fpga_unix'', ''jd'' and
+        ''lst''. None if the file has no TIMES table.
+        """
+        info = self._index.get('times')
+        if info is None:
+            return None
+        if self._mmap is None:
+            self._mmap = np.memmap(self.filename, dtype=np.uint8, mode='r')
+        records = np.ndarray((info['nrows'],), dtype=self._dtype(info['columns']), buffer=self._mmap, 
+                             offset=info['offset'])
+        return dict((name, records[name]) for name, _, _, _, _ in info['columns'])
+
+    def __len__(self):
+        if self.layout == 'table':
+            return self.nrows
+        return len(self.offsets)
+
+    def _records(self, start, stop, step):
+        """
+        Memory-mapped records of integrations start:stop:step.
+        """
+        if self._mmap is None:
+            self._mmap = np.memmap(self.filename, dtype=np.uint8, mode='r')
+        if self.layout == 'table':
+            nrows = self.nrows
+            records = np.ndarray((nrows,), dtype=self.dtype, buffer=self._mmap, offset=int(self.offsets[0]))
+            return records[start:stop:step]
+        offsets = self.offsets[start:stop:step]
+        shape = (len(offsets), self.nrows)
+        if len(offsets) == 0:
+            return np.empty(shape, dtype=self.dtype)
+        strides = np.diff(offsets)
+        if len(offsets) == 1 or np.all(strides == strides[0]):
+            # Equally spaced tables: one strided view
+            stride = int(strides[0]) if len(offsets) > 1 else 0
+            return np.ndarray(shape, dtype=self.dtype, buffer=self._mmap, offset=int(offsets[0]),
+                              strides=(stride, self.dtype.itemsize))
+        return np.stack([np.ndarray((self.nrows,), dtype=self.dtype, buffer=self._mmap, offset=int(offset))
+                         for offset in offsets])
+
+    def read(self, products=None, start=0, stop=None, step=1, raw=False):
+        """
+        Spectra of a range of integrations.
+
+        Inputs:
+        - products: Column names, default all of ''products''.
+        - start, stop, step: Integrations to read, as in a slice.
+        - raw: If True, return integer columns as stored, without 
+            applying their TSCALn/TZEROn scale.
+        Returns:
+        - Dictionary of (integration, channel) arrays, one per product.
+        """
+        if products is None:
+            products = self.products
+        start, stop, step = slice(start, stop, step).indices(len(self))
+        records = self._records(start, stop, step)
+        scales = dict((name, (scale, zero)) for name, _, _, scale, zero in self.columns)
+        data = {}
+        for name in products:
+            if name not in scales:
+                raise KeyError("No such product: " + name)
+            array = records[name]
+            scale, zero = scales[name]
+            if not raw and (scale is not None or zero is not None):
+                array = array*(1. if scale is None else scale) + (0. if zero is None else zero)
+            data[name] = array
+        return data
+
+    def __getitem__(self, key):
+        """
+        ''reader['auto0_real']'' returns one product for all integrations,
+        ''reader[10:20]'' all products of a range of integrations and
+        ''reader[10]'' all products of one integration.
+        """
+        if isinstance(key, str):
+            return self.read([key])[key]
+        if isinstance(key, slice):
+            return self.read(start=key.start, stop=key.stop, step=key.step or 1)
+        key = range(len(self))[key]
+        return dict((name, array[0]) for name, array in self.read(start=key, stop=key + 1).items())
+
+    def close(self):
+        """
+        Release the memory map.
+        """
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Create on-host accumulator
+class Accumulator(object):
+    """
+    Reduction stage between the correlator readout and a FitsStreamWriter.
+    It combines ''ndumps'' consecutive dumps by summing or averaging them
+    in place and only passes the reduced spectra on to the writer, 
+    lowering the output data rate. Optionally the per-channel variance,
+    minimum and maximum of each group are written as ''<name>_var'',
+    ''<name>_min'' and ''<name>_max'' columns.
+
+    It has the interface of the writer (''write'', ''flush'', 
+    ''update_header'', ''close'') so it can be used in its place.
+    """
+
+    def __init__(self, writer, ndumps, mode='mean', stats=False):
+        """
+        Inputs:
+        - writer: FitsStreamWriter receiving the reduced spectra.
+        - ndumps: Number of consecutive dumps combined.
+        - mode: 'mean' or 'sum'.
+        - stats: If True, also track per-channel variance, min and max.
+        """
+        if mode not in REDUCTIONS:
+            raise ValueError("Invalid reduction supplied: " + str(mode))
+        if ndumps < 1:
+            raise ValueError("ndumps must be at least 1: " + str(ndumps))
+        if ndumps > 1 and mode == 'mean' and getattr(writer, 'encoding', None) == 'int':
+            raise ValueError("The 'int' encoding would round the mean of the dumps, use mode='sum'.")
+        self.writer = writer
+        self.ndumps = ndumps
+        self.mode = mode
+        self.stats = stats
+        self._n = 0
+        self._sum = None
+
+    def _allocate(self, data):
+        """
+        Allocate the running sums and output arrays on the first dump.
+        """
+        self._sum = dict((name, np.zeros(np.shape(array))) for name, array in data.items())
+        self._out = dict((name, np.empty(np.shape(array))) for name, array in data.items())
+        if self.stats:
+            self._sumsq = dict((name, np.zeros(np.shape(array))) for name, array in data.items())
+            self._min = dict((name, np.empty(np.shape(array))) for name, array in data.items())
+            self._max = dict((name, np.empty(np.shape(array))) for name, array in data.items())
+            self._tmp = dict((name, np.empty(np.shape(array))) for name, array in data.items())
+            for name in data:
+                self._out[name+'_var'] = np.empty(np.shape(data[name]))
+                self._out[name+'_min'] = self._min[name]
+                self._out[name+'_max'] = self._max[name]
+
+    def write(self, data, meta=None):
+        """
+        Add one dump. The reduced spectra are written once ''ndumps''
+        dumps have been added.
+        """
+        if self._sum is None:
+            self._allocate(data)
+        if self._n == 0:
+            self._meta = dict(meta or {})
+            for name, array in data.items():
+                np.copyto(self._sum[name], array)
+                if self.stats:
+                    np.square(array, out=self._sumsq[name])
+                    np.copyto(self._min[name], array)
+                    np.copyto(self._max[name], array)
+        else:
+            for key in ('gap', 'desync'):
+                if meta is not None and key in self._meta:
+                    self._meta[key] += meta[key]
+            for name, array in data.items():
+                np.add(self._sum[name], array, out=self._sum[name])
+                if self.stats:
+                    np.square(array, out=self._tmp[name])
+                    np.add(self._sumsq[name], self._tmp[name], out=self._sumsq[name])
+                    np.minimum(self._min[name], array, out=self._min[name])
+                    np.maximum(self._max[name], array, out=self._max[name])
+        self._n += 1
+        if self._n == self.ndumps:
+            self._emit()
+
+    def _emit(self):
+        """
+        Write the reduced spectra of the current group.
+        """
+        n = self._n
+        for name, total in self._sum.items():
+            out = self._out[name]
+            np.multiply(total, 1./n, out=out) # mean
+            if self.stats:
+                var = self._out[name+'_var']
+                np.multiply(self._sumsq[name], 1./n, out=var)
+                np.square(out, out=self._tmp[name])
+                np.subtract(var, self._tmp[name], out=var)
+                np.maximum(var, 0., out=var)
+            if self.mode == 'sum':
+                np.copyto(out, total)
+        meta = self._meta
+        meta['ndumps'] = n
+        self.writer.write(self._out, meta=meta)
+        self._n = 0
+
+    def flush(self):
+        """
+        Write a partial group, if any, and flush the writer.
+        """
+        if self._n:
+            self._emit()
+        self.writer.flush()
+
+    def update_header(self, key, value):
+        self.writer.update_header(key, value)
+
+    def close(self, complete=True):
+        """
+        Write a partial group, if any, and close the writer.
+        """
+        if self._n:
+            self._emit()
+        self.writer.close(complete)
+
+
+# Create acquisition pipeline
+class AcquisitionPipeline(object):
+    """
+    Producer/consumer pipeline that decouples BRAM readout from whatever
+    consumes the dumps (FITS serialization, disk I/O). The producer (the
+    reader thread of ''Spectrometer.iter_dumps'') only waits on 
+    ''acc_cnt'' and copies BRAMs into preallocated NumPy buffers taken 
+    from a fixed pool, and hands them through a bounded queue to the 
+    consumer, which takes them with ''get'' and returns them to the pool
+    with ''release''.
+
+    If the consumer falls behind and no free buffer is available, the
+    dump is dropped rather than stalling the readout; ''dropped''
+    counts these.
+    """
+
+    def __init__(self, shapes, nbuffers=NBUFFERS):
+        """
+        Inputs:
+        - shapes: Dictionary mapping buffer names to (shape, dtype).
+        - nbuffers: Number of preallocated buffer sets, which is also
+            the depth of the queue.
+        """
+        if nbuffers < 1:
+            raise ValueError("nbuffers must be at least 1: " + str(nbuffers))
+        self.nbuffers = nbuffers
+        self._free = queue.Queue()
+        for i in range(nbuffers):
+            self._free.put(dict((name, np.empty(shape, dtype=dtype)) 
+                                for name, (shape, dtype) in shapes.items()))
+        self._full = queue.Queue() # bounded by the buffer pool
+        self._error = None
+
+        # Counters
+        self.nread = 0
+        self.nwritten = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def get_buffers(self):
+        """
+        Take a free buffer set from the pool. Returns None and counts a
+        dropped dump if the consumer has not released any.
+        """
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return None
+
+    def put(self, buffers, meta):
+        """
+        Hand a filled buffer set to the consumer.
+        """
+        self._full.put((buffers, meta))
+        self.nread += 1
+        self.max_depth = max(self.max_depth, self._full.qsize())
+
+    def get(self):
+        """
+        Take the next filled buffer set and its metadata, waiting for it
+        if needed. Returns None once the producer has called ''stop'', 
+        and re-raises an error passed to ''abort''.
+        """
+        item = self._full.get()
+        if item is None:
+            if self._error is not None:
+                raise self._error
+            return None
+        self.nwritten += 1
+        return item
+
+    def release(self, buffers):
+        """
+        Return a buffer set taken with ''get'' to the pool.
+        """
+        self._free.put(buffers)
+
+    def abort(self, error):
+        """
+        Stop the pipeline because of an error of the producer, which 
+        ''get'' re-raises.
+        """
+        self._error = error
+        self._full.put(None)
+
+    def stop(self):
+        """
+        Mark the end of the data for ''get''.
+        """
+        self._full.put(None)
+
+    def stats(self):
+        """
+        Counters of the pipeline.
+        """
+        return {'nread': self.nread, 'nwritten': self.nwritten, 
+                'dropped': self.dropped, 'max_depth': self.max_depth}
+
+
+# Create dump accounting
+class DumpStats(object):
+    """
+    Accounting of the accumulation dumps of an acquisition. Missed dumps
+    and correlator desyncs are flagged per integration rather than 
+    aborting the observation, and summarized at the end:
+    - skipped: dumps that passed before the host polled ''acc_cnt'' 
+        (the host was too slow to read them).
+    - dropped: dumps that were seen but discarded because the writer 
+        fell behind.
+    - desyncs: integrations where corr_1's ''acc_cnt'' did not match 
+        corr_0's, i.e. the two correlators were not read from the same
+        accumulation (an FPGA or readout timing issue).
+    """
+
+    def __init__(self, metrics=None):
+        """
+        Inputs:
+        - metrics: Optional ''Metrics'' whose dump counters are updated.
+        """
+        self.metrics = metrics
+        self.nspec = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.desyncs = 0
+        self.first_cnt = None
+        self.last_cnt = None
+        self.first_unix = None
+        self.last_unix = None
+        self._resumed = None # whether acc_cnt continued across the interruption, see restore
+
+    def restore(self, state, nspec, continuous=True):
+        """
+        Continue the accounting of an interrupted acquisition.
+
+        Inputs:
+        - state: ''summary'' saved with its last checkpoint, or None.
+        - nspec: Dumps written before the interruption.
+        - continuous: Whether acc_cnt kept counting during the interruption,
+            i.e. the SNAP was not reinitialized.
+        """
+        state = state or {}
+        self.nspec = nspec
+        for key in ('skipped', 'dropped', 'desyncs'):
+            setattr(self, key, state.get(key, 0))
+        # Dumps already read but not yet written were lost
+        self.dropped += max(state.get('nspec', nspec) - nspec, 0)
+        for key in ('first_cnt', 'last_cnt', 'first_unix', 'last_unix'):
+            setattr(self, key, state.get(key))
+        self._resumed = continuous if self.last_cnt is not None else None
+
+    def record(self, cnt_0, cnt_1, skipped=0, unix=None):
+        """
+        Record one stored integration.
+
+        Inputs:
+        - cnt_0, cnt_1: acc_cnt of corr_0 and corr_1 for the integration.
+        - skipped: Dumps skipped before it, as reported by ''wait_for_cnt''.
+            Dumps before the first integration are not counted. For the 
+            first integration after ''restore'', the dumps lost while the
+            acquisition was interrupted are counted instead, if the SNAP
+            kept counting.
+        - unix: Time at which the dump was seen.
+        Returns:
+        - Dictionary of per-integration metadata: ''acc_cnt'' (corr_0),
+          ''acc_cnt1'' (corr_1), ''gap'' (dumps missing since the previous 
+          stored integration), ''desync'' (1 if the counts differ) and
+          ''unix''.
+        """
+        if self.last_cnt is None:
+            gap = 0
+            skipped = 0
+            self.first_cnt = cnt_0
+            self.first_unix = unix
+        elif self._resumed is not None:
+            # Dumps lost while interrupted, unknown if acc_cnt restarted
+            gap = max(cnt_0 - self.last_cnt - 1, 0) if self._resumed else 0
+            skipped = gap
+            self._resumed = None
+        else:
+            gap = max(cnt_0 - self.last_cnt - 1, 0)
+        desync = int(cnt_0 != cnt_1)
+        if desync:
+            self.desyncs += 1
+            LOG.warning('Correlators out of sync: corr_0 acc_cnt %d, corr_1 acc_cnt %d.' % (cnt_0, cnt_1))
+        self.skipped += skipped
+        self.nspec += 1
+        self.last_cnt = cnt_0
+        if self.metrics is not None:
+            self.metrics.inc('dumps_seen')
+            if skipped:
+                self.metrics.inc('dumps_missed', skipped)
+            if desync:
+                self.metrics.inc('desyncs')
+        self.last_unix = unix
+        return {'acc_cnt': cnt_0, 'acc_cnt1': cnt_1, 'gap': gap, 'desync': desync, 'unix': unix}
+
+    def drop(self):
+        """
+        Record a dump discarded by the host.
+        """
+        self.dropped += 1
+        if self.metrics is not None:
+            self.metrics.inc('dumps_missed')
+
+    def summary(self):
+        """
+        Summary of the acquisition.
+        """
+        return {'nspec': self.nspec, 'missed': self.skipped + self.dropped, 
+                'skipped': self.skipped, 'dropped': self.dropped, 'desyncs': self.desyncs,
+                'first_cnt': self.first_cnt, 'last_cnt': self.last_cnt,
+                'first_unix': self.first_unix, 'last_unix': self.last_unix}
+
+    def log(self):
+        """
+        Log the summary, as a warning if any dumps were lost.
+        """
+        summary = self.summary()
+        msg = ('Acquired %(nspec)d spectra: %(missed)d dumps missed (%(skipped)d skipped, '
+               '%(dropped)d dropped), %(desyncs)d desynced.' % summary)
+        if summary['missed'] or summary['desyncs']:
+            LOG.warning(msg)
+        else:
+            LOG.info(msg)
+
+
+# Create header factory
+class HeaderFactory(object):
+    """
+    Builds the primary headers of a Spectrometer's FITS files. The static
+    spectrometer metadata is read from the SNAP once and cached, and
+    coordinate conversions are memoized per target, so repeated pointings 
+    do not pay for the astropy frame transforms again. A whole scan plan 
+    can be converted up front in one vectorized call with ''precompute''.
+    """
+
+    def __init__(self, spectrometer):
+        """
+        Inputs:
+        - spectrometer: Spectrometer whose metadata is recorded.
+        """
+        self.spectrometer = spectrometer
+        self._static = None
+        self._coords = {}
+
+    def static_header(self):
+        """
+        Header with the metadata of the system and spectrometer. Built
+        on first use.
+        """
+        if self._static is None:
+            spec = self.spectrometer
+            header = fits.Header()
+            header['NSPEC'] = (0, "Number of spectra collected")
+            header['FPGFILE'] = (spec.fpgfile, "FPGA FPG file")
+            header['HOST'] = (spec.s.fpga.host, "Host of the FPGA")
+            header['TRANSPORT'] = (spec.transport, "Communication protocal")
+            # header['CLK'] = (self.s.fpga.estimate_fpga_clock(), "FPGA clock speed [MHz]")
+            # header['ADC'] = (self.adc_rate, "ADC clock speed [Hz]")
+            header['ADC_NAME'] = (spec.s.adc.adc.name, "Name of ADC")
+            # header['DOWNSAMPLE'] = (self.downsample, "ADC downsampling period")
+            # header['SAMPRATE'] = (self.samp_rate, "Downsampled clock speed [Hz]")
+            # header['BW'] = (self.bandwidth, "Bandwidth of spectra [Hz]")
+            # header['NCHAN'] = (self.nchan, "Number of frequency channels")
+            # header['RES'] = (self.resolution, "Frequency resolution [Hz]")
+            # header['FFTSHIFT'] = (self.fft_shift, "FFT shifting instructions")
+            # header['ACCLEN'] = (self.acc_len, "Number of clock cycles")
+            # header['INTTIME'] = (self.int_time, "Integration time of spectra")
+            # header['SCALE'] = (self.scale, "Average instead of sum on SNAP")
+            header['PYTHON'] = (3.8, "Python version")
+            header['SRC'] = ('https://github.com/darbymccauley/Leuschner_Spectrometer.git', "Source code")
+            # header['CASPERFPGA'] = (CASPERFPGA_VERSION, "casperfpga code used")
+            # header['HERA_CORR_F'] = (HERA_CORR_F_VERSION, "hera_corr_f code used")
+            self._static = header
+        return self._static
+
+    def _key(self, coords, coord_sys):
+        """
+        Cache key of a target.
+        """
+        if coord_sys not in COORD_SYSTEMS:
+            raise ValueError("Invalid coordinate system supplied: " + str(coord_sys))
+        c0, c1 = coords
+        return (coord_sys, float(c0), float(c1))
+
+    def precompute(self, coords, coord_sys='ga'):
+        """
+        Convert the coordinates of many targets in one vectorized SkyCoord
+        transform and cache the results.
+
+        Inputs:
+        - coords: Sequence of (l/ra, b/dec) pairs [deg].
+        - coord_sys: Coordinate system of ''coords'', 'ga' or 'eq'.
+        Returns:
+        - List of (l, b, ra, dec) tuples [deg], one per target.
+        """
+        keys = [self._key(c, coord_sys) for c in coords]
+        todo = [key for key in set(keys) if key not in self._coords]
+        if todo:
+            c0 = np.array([key[1] for key in todo])*u.degree
+            c1 = np.array([key[2] for key in todo])*u.degree
+            if coord_sys == 'ga':
+                equatorial = coordinates.SkyCoord(l=c0, b=c1, frame='galactic').fk5
+                l, b = c0, c1
+                ra, dec = equatorial.ra, equatorial.dec
+            elif coord_sys == 'eq':
+                galactic = coordinates.SkyCoord(c0, c1).galactic
+                ra, dec = c0, c1
+                l, b = galactic.l, galactic.b
+            for i, key in enumerate(todo):
+                self._coords[key] = (float(l[i].value), float(b[i].value), 
+                                     float(ra[i].value), float(dec[i].value))
+        return [self._coords[key] for key in keys]
+
+    def convert(self, coords, coord_sys='ga'):
+        """
+        Galactic and equatorial coordinates (l, b, ra, dec) [deg] of one
+        target, from the cache if it has been converted before.
+        """
+        key = self._key(coords, coord_sys)
+        if key not in self._coords:
+            self.precompute([coords], coord_sys)
+        return self._coords[key]
+
+    def make_PrimaryHDU(self, nspec, coords, coord_sys='ga', obs_start_unix=None):
+        """
+        Make the PrimaryHDU of a FITS file. See 
+        ''Spectrometer.make_PrimaryHDU''.
+
+        Inputs:
+        - obs_start_unix: Start time of the observation. Defaults to now.
+        """
+        l, b, ra, dec = self.convert(coords, coord_sys)
+
+        header = self.static_header().copy()
+        header['NSPEC'] = nspec
+
+        # Save observation attributes
+        header['L'] = (l, "Galactic longitude [deg]")
+        header['B'] = (b, "Galactic latitude [deg]")
+        header['RA'] = (ra, "Right Ascension [deg]")
+        header['DEC'] = (dec, "Declination [deg]")
+        self.set_start(header, obs_start_unix)
+
+        primaryhdu = fits.PrimaryHDU(header=header)
+        return primaryhdu
+
+    def set_start(self, header, obs_start_unix=None):
+        """
+        Set the start time (JD and UNIX) of the observation in a header,
+        e.g. of one made ahead of time. Defaults to now.
+        """
+        # Set times; the unix time scale ignores leap seconds like UTC JD
+        if obs_start_unix is None:
+            obs_start_unix = time.time() #unix time
+        obs_start_jd = UNIX_EPOCH_JD + obs_start_unix/86400. #convert unix time to julian date
+        header['JD'] = (obs_start_jd, "Julian date of start time")
+        header['UNIX'] = (obs_start_unix, "Seconds since epoch")
+
+
+# Create hardware backend
+class SnapBackend(object):
+    """
+    Spectrometer backend connecting to the SNAP board through casperfpga
+    and hera_corr_f.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        """
+        Inputs:
+        - cache_dir: Directory for the parsed design metadata and the
+            record of the programmed bitstream.
+        """
+        self.cache_dir = cache_dir
+
+    def connect(self, host, transport):
+        """
+        Returns:
+        - (fpga, snap) handles: casperfpga.CasperFpga and 
+          hera_corr_f.SnapFengine.
+        """
+        fpga = casperfpga.CasperFpga(host)
+        snap = hera_corr_f.SnapFengine(host, transport=transport)
+        return fpga, snap
+
+    def parse_fpg(self, fpgfile):
+        """
+        Parse the register and BRAM metadata of a design file, in the
+        form taken by ''CasperFpga.get_system_information(fpg_info=...)''.
+        """
+        return casperfpga.casperfpga.parse_fpg(fpgfile)
+
+    def _record_file(self, host):
+        return os.path.join(self.cache_dir, 'programmed-%s.json' % host)
+
+    def programmed_hash(self, host):
+        """
+        Content hash of the bitstream last programmed on ''host'' from 
+        this control host, or None if unknown.
+        """
+        try:
+            with open(self._record_file(host)) as f:
+                return json.load(f)['sha256']
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def record_programmed(self, host, fpgfile, digest):
+        """
+        Remember which bitstream was programmed on ''host''.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self._record_file(host), 'w') as f:
+            json.dump({'fpgfile': fpgfile, 'sha256': digest, 'unix': time.time()}, f)
+
+
+_FPG_HASHES = {}
+
+def fpg_hash(fpgfile):
+    """
+    SHA-256 of the content of a design file, cached per file and 
+    modification time.
+    """
+    stat = os.stat(fpgfile)
+    key = (os.path.abspath(fpgfile), stat.st_mtime, stat.st_size)
+    if key not in _FPG_HASHES:
+        digest = hashlib.sha256()
+        with open(fpgfile, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                digest.update(chunk)
+        _FPG_HASHES[key] = digest.hexdigest()
+    return _FPG_HASHES[key]
+
+
+def load_fpg_info(backend, fpgfile, digest, cache_dir=CACHE_DIR):
+    """
+    Parsed metadata of a design file, from an on-disk cache keyed by the
+    file's content hash. The design is parsed and the cache written on
+    first use.
+    """
+    cache_file = os.path.join(cache_dir, 'fpg-%s.pkl' % digest)
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        pass
+    fpg_info = backend.parse_fpg(fpgfile)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = cache_file + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(fpg_info, f)
+        os.replace(tmp, cache_file)
+    except (IOError, pickle.PicklingError) as e:
+        LOG.warning('Could not cache design metadata: %s' % e)
+    return fpg_info
+
+
+# Create ring of spectrum buffers
+class BufferRing(object):
+    """
+    Fixed set of preallocated arrays handed out in turn, so that spectra
+    can be read without allocating new arrays. An array is reused after
+    ''size'' further calls to ''next'', so consumers must be done with it
+    by then.
+    """
+
+    def __init__(self, size, shape=(NCHAN,), dtype=float):
+        """
+        Inputs:
+        - size: Number of arrays in the ring.
+        - shape, dtype: Shape and type of each array.
+        """
+        if size < 1:
+            raise ValueError("size must be at least 1: " + str(size))
+        self.buffers = [np.empty(shape, dtype=dtype) for i in range(size)]
+        self._index = 0
+
+    def next(self):
+        """
+        Next array of the ring.
+        """
+        buf = self.buffers[self._index]
+        self._index = (self._index + 1) % len(self.buffers)
+        return buf
+
+
+# Create shared-memory ring of dumps
+class SharedRing(object):
+    """
+    Ring of the latest ''size'' dumps in a ''multiprocessing.shared_memory''
+    block, written by the acquisition loop (see ''Spectrometer.share'') so
+    that quicklook plots, RFI monitors or archivers can run as separate
+    processes without ever blocking the readout. Readers attach by name 
+    with ''SharedRingReader''.
+
+    The block starts with a JSON description of the layout, followed by
+    the number of dumps written so far, a closed flag, the process ID of
+    the writer and the slots, a NumPy record 
+    array holding the dump metadata and every product. Each slot has a
+    sequence number used as a seqlock: it is odd while the slot is being
+    written and 2*(n + 1) once it holds dump n, so readers never lock and
+    detect a slot overwritten under them.
+    """
+
+    def __init__(self, shapes, size=SHM_SLOTS, name=None):
+        """
+        Create the shared-memory block. An existing block of the same 
+        name is only replaced if its writer closed it or no longer runs
+        (e.g. it was left over by a crashed run).
+
+        Inputs:
+        - shapes: Dictionary of the (shape, dtype) of each product.
+        - size: Number of dumps held.
+        - name: Name of the shared-memory block. Default is 
+            ''shared_name()''.
+        Raises:
+        - FileExistsError if a running process still writes to a block 
+          of that name.
+        """
+        if name is None:
+            name = shared_name()
+        if size < 1:
+            raise ValueError("size must be at least 1: " + str(size))
+        fields = list(SHM_META) + [(product, np.dtype(dtype), shape) 
+                                   for product, (shape, dtype) in sorted(shapes.items())]
+        self.dtype = np.dtype(fields, align=True)
+        self.shapes = dict((product, (tuple(shape), np.dtype(dtype))) for product, (shape, dtype) in shapes.items())
+        self.size = size
+        layout = json.dumps({'size': size, 'itemsize': self.dtype.itemsize, 'fields': _dtype_fields(self.dtype)})
+        if len(layout) >= SHM_HEADER:
+            raise ValueError("Too many products for the shared-memory header: " + str(sorted(shapes)))
+
+        nbytes = SHM_HEADER + SHM_CONTROL + size*self.dtype.itemsize
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=nbytes)
+        except FileExistsError:
+            self._replace(name)
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=nbytes)
+        self.name = name
+        _SHARED_NAMES.add(name)
+        self.shm.buf[:SHM_HEADER] = layout.encode().ljust(SHM_HEADER, b'\0')
+        self._control = np.ndarray((3,), dtype=np.int64, buffer=self.shm.buf, offset=SHM_HEADER)
+        self._control[:] = (0, 0, os.getpid()) # dumps written, closed flag, writer
+        self._slots = np.ndarray((size,), dtype=self.dtype, buffer=self.shm.buf, offset=SHM_HEADER + SHM_CONTROL)
+        self._seq = self._slots['seq']
+        self._seq[:] = 0
+        self.nwritten = 0
+        LOG.info('Sharing the last %d dumps in shared memory %s (%d bytes).' % (size, name, nbytes))
+
+    def _replace(self, name):
+        """
+        Remove an existing block named ''name'', unless its writer has not
+        closed it and still runs.
+        """
+        old = shared_memory.SharedMemory(name=name)
+        closed, pid = 0, 0 # unknown writer
+        if old.size >= SHM_HEADER + SHM_CONTROL:
+            control = np.ndarray((3,), dtype=np.int64, buffer=old.buf, offset=SHM_HEADER)
+            closed, pid = int(control[1]), int(control[2])
+            del control
+        if not closed and (pid <= 0 or _running(pid)):
+            if name not in _SHARED_NAMES:
+                resource_tracker.unregister(old._name, 'shared_memory')
+            old.close()
+            raise FileExistsError("Shared memory %s is in use by process %s, unshare it there or use another name." % (
+                name, pid if pid > 0 else 'unknown'))
+        LOG.warning('Replacing shared memory %s left over by process %d.' % (name, pid))
+        old.close()
+        old.unlink()
+
+    def matches(self, shapes):
+        """
+        Whether the ring holds exactly the products of ''shapes''.
+        """
+        return self.shapes == dict((product, (tuple(shape), np.dtype(dtype))) 
+                                   for product, (shape, dtype) in shapes.items())
+
+    def write(self, data, meta):
+        """
+        Copy a dump into the next slot.
+
+        Inputs:
+        - data: Dictionary of the spectra of each product.
+        - meta: Dump metadata (see ''DumpStats.record'').
+        """
+        n = self.nwritten
+        index = n % self.size
+        slot = self._slots[index]
+        self._seq[index] = 2*n + 1
+        for key in SHM_KEYS:
+            value = meta.get(key)
+            slot[key] = -1 if value is None else value
+        for product, array in data.items():
+            slot[product] = array
+        self._seq[index] = 2*n + 2
+        self.nwritten = n + 1
+        self._control[0] = n + 1
+
+    def close(self):
+        """
+        Mark the ring closed for the readers and remove the block. Readers
+        that are attached keep their mapping until they close it.
+        """
+        if self.shm is None:
+            return
+        self._control[1] = 1
+        del self._slots, self._seq, self._control
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+        _SHARED_NAMES.discard(self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+_SHARED_NAMES = set() # SharedRings created by this process
+
+def shared_name(host=HOST):
+    """
+    Default name of the shared-memory ring of the board at ''host'', so
+    that several boards can share their dumps side by side.
+    """
+    return SHM_NAME + '_' + re.sub(r'[^A-Za-z0-9]', '_', host)
+
+
+def _running(pid):
+    """
+    Whether a process ''pid'' runs on this host.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass # it runs as another user
+    return True
+
+def _dtype_fields(dtype):
+    """
+    JSON-serializable description of a record dtype: (name, base type,
+    shape, offset) of every field.
+    """
+    fields = []
+    for name in dtype.names:
+        field, offset = dtype.fields[name][:2]
+        base, shape = (field.subdtype if field.subdtype is not None else (field, ()))
+        fields.append([name, base.str, list(shape), offset])
+    return fields
+
+
+class SharedRingReader(object):
+    """
+    Client of a ''SharedRing'' in another process. The slots are mapped as
+    NumPy arrays without copying; reads take no lock and are validated 
+    with the sequence number of the slot, so a reader can never stall the
+    writer, it can only fall behind and miss dumps.
+
+        ring = SharedRingReader()
+        while not ring.closed:
+            dump = ring.next(timeout=5)
+            if dump is not None:
+                print(dump['acc_cnt'], dump['data']['auto0'].mean())
+
+    The validation relies on the stores of the writer becoming visible in
+    program order, as they do on x86-64.
+    """
+
+    def __init__(self, name=None):
+        """
+        Inputs:
+        - name: Name of the shared-memory block (see ''Spectrometer.share'').
+            Default is ''shared_name()''.
+        """
+        if name is None:
+            name = shared_name()
+        self.shm = shared_memory.SharedMemory(name=name)
+        if name not in _SHARED_NAMES:
+            # Only the writer may remove the block when its process exits
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.name = name
+        layout = json.loads(bytes(self.shm.buf[:SHM_HEADER]).rstrip(b'\0').decode())
+        fields = layout['fields']
+        self.dtype = np.dtype({'names': [field[0] for field in fields],
+                               'formats': [(field[1], tuple(field[2])) if field[2] else field[1] for field in fields],
+                               'offsets': [field[3] for field in fields], 'itemsize': layout['itemsize']})
+        self.size = layout['size']
+        self.products = [field[0] for field in fields if field[0] not in dict(SHM_META)]
+        self._control = np.ndarray((2,), dtype=np.int64, buffer=self.shm.buf, offset=SHM_HEADER)
+        self._slots = np.ndarray((self.size,), dtype=self.dtype, buffer=self.shm.buf, offset=SHM_HEADER + SHM_CONTROL)
+        self._seq = self._slots['seq']
+        self._next = None
+        self.missed = 0
+
+    @property
+    def nwritten(self):
+        """
+        Number of dumps written to the ring so far.
+        """
+        return int(self._control[0])
+
+    @property
+    def closed(self):
+        """
+        Whether the writer has closed the ring.
+        """
+        return bool(self._control[1])
+
+    def valid(self, n):
+        """
+        Whether the slot of dump ''n'' (counted from 0) still holds it.
+        """
+        return self._seq[n % self.size] == 2*n + 2
+
+    def views(self, n):
+        """
+        Zero-copy views of the spectra of dump ''n''. They are overwritten
+        once the writer laps the ring, so check ''valid(n)'' after using 
+        them, or use ''read''.
+        Returns:
+        - Dictionary of the arrays of each product.
+        """
+        slot = self._slots[n % self.size]
+        return dict((product, slot[product]) for product in self.products)
+
+    def read(self, n):
+        """
+        Copy of dump ''n''.
+        Returns:
+        - Dictionary with the dump metadata (see ''DumpStats.record''), 
+          ''n'' and ''data'', the spectra of each product, or None if the
+          dump is not in the ring (not yet written or already overwritten).
+        """
+        index = n % self.size
+        seq = self._seq[index]
+        if seq != 2*n + 2:
+            return None
+        slot = self._slots[index:index + 1].copy()[0]
+        if self._seq[index] != seq:
+            return None
+        dump = dict((key, slot[key].item()) for key in SHM_KEYS)
+        dump['n'] = n
+        dump['data'] = dict((product, slot[product]) for product in self.products)
+        return dump
 
-import numpy as np
-import time 
-import logging
-from astropy.coordinates import SkyCoord
-import astropy.units as u
-from astropy.time import Time
-from astropy.io import fits
-import os, sys
+    def latest(self):
+        """
+        Copy of the newest complete dump, or None if there is none yet.
+        """
+        while True:
+            nwritten = self.nwritten
+            if nwritten == 0:
+                return None
+            dump = self.read(nwritten - 1)
+            if dump is not None:
+                return dump
+
+    def next(self, timeout=None, poll=POLL_TIME):
+        """
+        Wait for the dump after the last one returned, starting with the 
+        newest. Dumps overwritten before they were read are skipped and 
+        counted in ''missed''.
+
+        Inputs:
+        - timeout: Seconds to wait. None waits until a dump arrives or the
+            ring is closed.
+        - poll: Polling interval [s].
+        Returns:
+        - Copy of the dump (see ''read''), or None on timeout or if the 
+          ring was closed.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            nwritten = self.nwritten
+            if self._next is None and nwritten > 0:
+                self._next = nwritten - 1
+            if self._next is not None and self._next < nwritten:
+                if self._next < nwritten - self.size:
+                    self.missed += nwritten - self.size - self._next
+                    self._next = nwritten - self.size
+                dump = self.read(self._next)
+                if dump is None:
+                    # Overwritten while reading: catch up with the writer
+                    self.missed += 1
+                    self._next += 1
+                    continue
+                self._next += 1
+                return dump
+            if self.closed or (deadline is not None and time.time() > deadline):
+                return None
+            time.sleep(poll)
+
+    def close(self):
+        """
+        Unmap the ring. Views returned by ''views'' must be released first.
+        """
+        if self.shm is None:
+            return
+        del self._slots, self._seq, self._control
+        self.shm.close()
+        self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-DELAY_TIME = 0.1 # seconds
-HOST = 'localhost'
-FPGFILE = 'fpga/ugradio_corrspec_2022-02-22_0905.fpg'
-STREAM_1 = 0
-STREAM_2 = 1
-LOGGER = 'spectrometer.log'
-TRANSPORT = 'default'
-ACC_LEN = 38150
-SPEC_PER_ACC = 8
 
 # Create Spectrometer class
 class Spectrometer(object):
@@ -27,7 +2209,8 @@ class Spectrometer(object):
     Casperfpga interface to the SNAP spectrometer.
     """
 
-    def __init__(self, host=HOST, fpgfile=FPGFILE, transport=TRANSPORT, stream_1=STREAM_1, stream_2=STREAM_2, logger=None, acc_len=ACC_LEN, spec_per_acc=SPEC_PER_ACC):
+    def __init__(self, host=HOST, fpgfile=FPGFILE, transport=TRANSPORT, stream_1=STREAM_1, stream_2=STREAM_2, logger=None, acc_len=ACC_LEN, spec_per_acc=SPEC_PER_ACC,
+                 wait_timeout=None, backend=None, log_level=logging.INFO, location=None):
         """
         Create the interface to the SNAP.
 
@@ -36,20 +2219,42 @@ class Spectrometer(object):
         - fpgfile: design file used to program fpga.
         - transport: communication protocal.
         - stream_1, stream_2: SNAP ports used for correlation data aquisition.
-        - logger: filename in which log is recorded. 
+        - logger: filename in which log is recorded. The log is set up
+            by the first spectrometer of the process (see 
+            ''setup_logging''); the files of further ones are added to it
+            (see ''add_log_file''), so all files receive the log of every
+            board.
+        - log_level: Level of the spectrometer's log. DEBUG also logs 
+            every integration (see ''setup_logging''). Further 
+            spectrometers can only make the log more verbose.
+        - acc_len, spec_per_acc: Accumulation length settings of the correlators.
+        - wait_timeout: Seconds to wait for an accumulation dump before giving 
+            up. Default is three nominal dump periods plus one second.
+        - backend: Object whose ''connect(host, transport)'' returns the
+            (fpga, snap) handles. Default is the SNAP hardware 
+            (''SnapBackend''); 'sim' uses an in-process simulated SNAP
+            (''leuschner_sim.SimBackend'').
+        - location: Observatory (longitude [deg], latitude [deg], altitude
+            [m]) used for the LST of the dumps. Default is Leuschner 
+            (''ugradio.leo''), or no JD and LST if ugradio is not 
+            installed (see ''observatory_location'').
         """
         self.host = host
         self.fpgfile = fpgfile
         self.transport = transport
+        self.location = location
 
         if logger is None:
             self.logger = LOGGER
         elif logger is not None:
             self.logger = logger
-        logging.basicConfig(filename=self.logger, 
-                            format='%(asctime)s - %(levelname)s - %(message)s', 
-                            datefmt='%m/%d/%Y %I:%M:%S %p',
-                            level=logging.NOTSET)
+        # The log is process-wide: configure it once, and only add to it
+        # for further spectrometers (e.g. several boards)
+        if _LISTENER is None:
+            setup_logging(self.logger, level=log_level)
+        else:
+            add_log_file(self.logger)
+            LOG.setLevel(min(LOG.level, log_level))
 
         # Ports used for ADCs
         self.stream_1 = stream_1
@@ -57,9 +2262,25 @@ class Spectrometer(object):
         
         self.acc_len = acc_len
         self.spec_per_acc = spec_per_acc
+        self.pipeline = None # AcquisitionPipeline of the last threaded read
+        self.dump_stats = None # DumpStats of the last read
+        self.headers = HeaderFactory(self)
+        self.init_result = None # result of the last initialize
+        self.metrics = Metrics()
+        self.shared = None # SharedRing the dumps are published to
+        self._share = None # (name, size) of the SharedRing, see share
+
+        # Accumulation dump tracking used by wait_for_cnt
+        self.wait_timeout = wait_timeout
+        self.dumps_skipped = 0
+        self.reset_cnt()
 
-        self.fpga = casperfpga.CasperFpga(self.host)
-        self.s = SnapFengine(self.host, transport=self.transport)
+        if backend is None:
+            backend = SnapBackend()
+        elif backend == 'sim':
+            backend = leuschner_sim.SimBackend()
+        self.backend = backend
+        self.fpga, self.s = backend.connect(self.host, self.transport)
 
         
     def is_connected(self):
@@ -69,7 +2290,7 @@ class Spectrometer(object):
         if self.fpga.is_connected():
             return True
         else:
-            logging.warning('SNAP is not connected')
+            LOG.warning('SNAP is not connected')
             return False
 
 
@@ -80,53 +2301,174 @@ class Spectrometer(object):
         if self.fpga.is_running() and self.s.is_programmed():
             return True
         else:
-            logging.warning('SNAP is not programmed and running.')
+            LOG.warning('SNAP is not programmed and running.')
+
+
+    def reconnect(self):
+        """
+        Connect to the SNAP again, e.g. after the connection dropped or the
+        host rebooted, and initialize it if it is no longer running. A 
+        running SNAP is left untouched so its acc_cnt continues.
+        Returns:
+        - True if the SNAP had to be initialized.
+        """
+        LOG.info('Reconnecting to the SNAP at %s.' % self.host)
+        self.fpga, self.s = self.backend.connect(self.host, self.transport)
+        self.reset_cnt()
+        if self.is_running():
+            return False
+        self.initialize()
+        return True
 
   
-    def program(self):
+    def program(self, force=False):
         """
-        Program the fpga.
+        Program the fpga, unless it is already running the same bitstream.
+
+        The bitstream is identified by the content hash of ''fpgfile'', 
+        which is recorded by the backend whenever it is programmed. If 
+        the board is running and the recorded hash matches, programming 
+        is skipped. Otherwise the bitstream is uploaded once and shared by
+        both fpga handles. In both cases the register and BRAM metadata 
+        are loaded from an on-disk cache keyed by the hash instead of 
+        re-parsing the design file.
+
+        Inputs:
+        - force: Program even if the board runs the same bitstream, e.g.
+            if it may have been reprogrammed by another tool.
+        Returns:
+        - True if the fpga was programmed, False if it was skipped.
         """
-        self.fpga.upload_to_ram_and_program(self.fpgfile)
-        self.s.fpga.upload_to_ram_and_program(self.fpgfile)
+        digest = fpg_hash(self.fpgfile)
+        running = self.fpga.is_running() and self.s.is_programmed()
+        if not force and running and self.backend.programmed_hash(self.host) == digest:
+            LOG.info('SNAP is already running %s (sha256 %s), skipping programming.' % (self.fpgfile, digest[:12]))
+            programmed = False
+        else:
+            LOG.info('Programming %s (sha256 %s).' % (self.fpgfile, digest[:12]))
+            self.s.fpga.transport.upload_to_ram_and_program(self.fpgfile)
+            self.backend.record_programmed(self.host, self.fpgfile, digest)
+            programmed = True
+
+        # Register and BRAM metadata for both handles
+        fpg_info = load_fpg_info(self.backend, self.fpgfile, digest, self.backend.cache_dir)
+        for fpga in (self.fpga, self.s.fpga):
+            fpga.get_system_information(fpg_info=fpg_info)
+        return programmed
         
 
-    def initialize(self):
+    def _run_stage(self, name, func, retries=0, backoff=INIT_BACKOFF, before_retry=None):
         """
-        Programs the fpga on the SNAP and initializes the spectrometer.
+        Run one initialization stage, retrying it after failures.
+
+        Inputs:
+        - name: Name of the stage, used in the log and the result.
+        - func: Function running the stage.
+        - retries: Number of times a failed stage is retried.
+        - backoff: Delay before the first retry [s]. It doubles with every 
+            further retry.
+        - before_retry: Optional function called before every retry, e.g. 
+            to reset a block. A failure of it fails the attempt.
+        Returns:
+        - Dictionary with the ''stage'' name, whether it succeeded (''ok''),
+          the number of ''attempts'', the ''duration'' [s] and the last
+          ''error'' (None if it succeeded).
         """
-        logging.info('Starting the spectrometer.')
-        
-        # Program fpga
-        self.program()
+        start = time.time()
+        error = None
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                time.sleep(backoff * 2**(attempt - 1))
+            try:
+                if attempt > 0 and before_retry is not None:
+                    before_retry()
+                func()
+                error = None
+                break
+            except Exception as e:
+                error = e
+                LOG.warning('Stage %s failed (attempt %d of %d): %s' % (name, attempt + 1, retries + 1, e))
+        result = {'stage': name, 'ok': error is None, 'attempts': attempt + 1,
+                  'duration': time.time() - start, 'error': None if error is None else repr(error)}
+        LOG.info('Stage %s %s after %d attempt(s) in %.3f s.' % (name, 'done' if result['ok'] else 'failed',
+                                                                  result['attempts'], result['duration']))
+        return result
 
-        self.s.corr_0.set_acc_len(self.acc_len)
-        self.s.corr_1.set_acc_len(self.acc_len)
-        
-        # Initialize and align ADCs
-        logging.info('Aligning and initializing ADCs...')
-        try:
-            self.s.adc.init()
-            self.s.align_adc()
-            logging.info('ADCs aligned and initialized.')
-        except: ### No bare excepts
-            try: # try again (usually works after two attempts)
-                self.s.adc.init()
-                self.s.align_adc()
-                logging.info('ADCs aligned and initialized.')
-            except:
-                logging.error('Could not align and initialize ADCs.')
-                raise IOError('Could not align and initialize ADCs.')
-
-        # Initialize other blocks and both correlators
-        logging.info('Initializing other blocks, including PFB and both correlators.')
-        try:
-            self.s.initialize()
-        except:
-            self.s.pfb.initialize()
-            self.s.corr_0.initialize()
-            self.s.corr_1.initialize()
-        logging.info('Spectrometer is ready.')
+
+    def initialize(self, force_program=False, retries=INIT_RETRIES, backoff=INIT_BACKOFF, concurrent=True):
+        """
+        Programs the fpga on the SNAP (if it is not already running the 
+        design, see ''program'') and initializes the spectrometer.
+
+        Initialization runs in stages: program, set_acc_len, adc_init, 
+        adc_align and blocks (''SnapFengine.initialize'', which initializes
+        all other blocks of the design). Each stage is timed and retried 
+        with an exponential backoff. A retry of the ADC alignment 
+        re-initializes the ADC first. The blocks stage is not retried: 
+        if it fails (as it does on some designs), the blocks needed by the
+        spectrometer are initialized one by one right away instead: pfb, then corr_0 and corr_1, which are independent and 
+        are initialized concurrently.
+
+        Inputs:
+        - force_program: Program even if the board runs the same bitstream.
+        - retries: Number of times a failed stage is retried.
+        - backoff: Delay before the first retry of a stage [s]. It doubles
+            with every further retry.
+        - concurrent: If True (default), initialize both correlator blocks
+            at the same time when falling back to the per-block stages.
+        Returns:
+        - Dictionary with ''ok'', the total ''duration'' [s] and the list of
+          ''stages'' (see ''_run_stage''). It is also kept as 
+          ''self.init_result''. A failed blocks stage does not fail the
+          initialization if its fallback succeeds.
+        Raises:
+        - IOError if a stage still fails after all retries. The stages 
+          run up to that point are in ''self.init_result''.
+        """
+        LOG.info('Starting the spectrometer.')
+        start = time.time()
+        self.init_result = {'ok': False, 'duration': None, 'stages': []}
+        stages = self.init_result['stages']
+
+        def set_acc_len():
+            self.s.corr_0.set_acc_len(self.acc_len)
+            self.s.corr_1.set_acc_len(self.acc_len)
+
+        def corr_stage(name):
+            return self._run_stage(name, getattr(self.s, name).initialize, retries, backoff)
+
+        # Stages run one after the other
+        # The blocks stage is not retried, its fallback is
+        serial = [('program', lambda: self.program(force=force_program), retries, None),
+                  ('set_acc_len', set_acc_len, retries, None),
+                  ('adc_init', self.s.adc.init, retries, None),
+                  ('adc_align', self.s.align_adc, retries, self.s.adc.init),
+                  ('blocks', self.s.initialize, 0, None)]
+        for name, func, stage_retries, before_retry in serial:
+            stages.append(self._run_stage(name, func, stage_retries, backoff, before_retry))
+            if not stages[-1]['ok']:
+                break
+
+        # Fall back to the PFB and both correlators
+        blocks_failed = stages[-1]['stage'] == 'blocks' and not stages[-1]['ok']
+        if blocks_failed:
+            LOG.warning('Initializing the PFB and correlators one by one instead.')
+            stages.append(self._run_stage('pfb', self.s.pfb.initialize, retries, backoff))
+        if blocks_failed and stages[-1]['ok']:
+            if concurrent:
+                with ThreadPoolExecutor(max_workers=2) as pool:
+                    stages.extend(pool.map(corr_stage, ['corr_0', 'corr_1']))
+            else:
+                stages.extend(corr_stage(name) for name in ['corr_0', 'corr_1'])
+
+        self.init_result['duration'] = time.time() - start
+        failed = [stage['stage'] for stage in stages if not stage['ok'] and stage['stage'] != 'blocks']
+        if failed:
+            LOG.error('Could not initialize the spectrometer, failed stage(s): ' + ', '.join(failed))
+            raise IOError('Could not initialize the spectrometer, failed stage(s): ' + ', '.join(failed))
+        self.init_result['ok'] = True
+        LOG.info('Spectrometer is ready (%.3f s).' % self.init_result['duration'])
+        return self.init_result
 
 
     def make_PrimaryHDU(self, nspec, coords, coord_sys='ga'):
@@ -146,91 +2488,531 @@ class Spectrometer(object):
         - PrimaryHDU information containing the attributes 
         of the observation and spectrometer.
         """
-        # Ensure that a proper coordinate system has been supplied
-        if coord_sys != 'ga' and coord_sys != 'eq':
-            raise ValueError("Invalid coordinate system supplied: " + coord_sys)
-
-        # Set times
-        obs_start_unix = time.time() #unix time
-        unix_object = Time(obs_start_unix, format='unix', 
-                           location=(ugradio.leo.lon, ugradio.leo.lat, ugradio.leo.alt)) #unix time Time object
-        obs_start_jd = unix_object.jd #convert unix time to julian date
-
-        # Set the coordinates
-        if coord_sys == 'ga':
-            l, b = coords*u.degree
-            c = SkyCoord(l=l, b=b, frame='galactic')
-            equatorial = c.fk5
-            ra, dec = equatorial.ra, equatorial.dec
-        elif coord_sys == 'eq':
-            ra, dec = coords*u.degree
-            c = SkyCoord(ra, dec)
-            galactic = c.galactic
-            l, b = galactic.l, galactic.b
-        
-        # Make PrimaryHDU
-        header = fits.Header()
-
-        # Save metadata of the system and spectrometer
-        header['NSPEC'] = (nspec, "Number of spectra collected")
-        header['FPGFILE'] = (self.fpgfile, "FPGA FPG file")
-        header['HOST'] = (self.s.fpga.host, "Host of the FPGA")
-        header['TRANSPORT'] = (self.transport, "Communication protocal")
-        # header['CLK'] = (self.s.fpga.estimate_fpga_clock(), "FPGA clock speed [MHz]")
-        # header['ADC'] = (self.adc_rate, "ADC clock speed [Hz]")
-        header['ADC_NAME'] = (self.s.adc.adc.name, "Name of ADC")
-        # header['DOWNSAMPLE'] = (self.downsample, "ADC downsampling period")
-        # header['SAMPRATE'] = (self.samp_rate, "Downsampled clock speed [Hz]")
-        # header['BW'] = (self.bandwidth, "Bandwidth of spectra [Hz]")
-        # header['NCHAN'] = (self.nchan, "Number of frequency channels")
-        # header['RES'] = (self.resolution, "Frequency resolution [Hz]")
-        # header['FFTSHIFT'] = (self.fft_shift, "FFT shifting instructions")
-        # header['ACCLEN'] = (self.acc_len, "Number of clock cycles")
-        # header['INTTIME'] = (self.int_time, "Integration time of spectra")
-        # header['SCALE'] = (self.scale, "Average instead of sum on SNAP")
-        header['PYTHON'] = (3.8, "Python version")
-        header['SRC'] = ('https://github.com/darbymccauley/Leuschner_Spectrometer.git', "Source code")
-        # header['CASPERFPGA'] = (CASPERFPGA_VERSION, "casperfpga code used")
-        # header['HERA_CORR_F'] = (HERA_CORR_F_VERSION, "hera_corr_f code used")
-        
-        # Save observation attributes
-        header['L'] = (l.value, "Galactic longitude [deg]")
-        header['B'] = (b.value, "Galactic latitude [deg]")
-        header['RA'] = (ra.value, "Right Ascension [deg]")
-        header['DEC'] = (dec.value, "Declination [deg]")
-        header['JD'] = (obs_start_jd, "Julian date of start time")
-        header['UNIX'] = (obs_start_unix, "Seconds since epoch")
+        return self.headers.make_PrimaryHDU(nspec, coords, coord_sys)
 
-        primaryhdu = fits.PrimaryHDU(header=header)
-        return primaryhdu
 
+    def serve_metrics(self, port=METRICS_PORT, host='127.0.0.1'):
+        """
+        Serve the acquisition metrics (''self.metrics'') in the Prometheus
+        text format at http://host:port/metrics from a daemon thread. 
+        ''self.metrics.snapshot()'' returns the same values in process.
+
+        Inputs:
+        - port: TCP port. 0 picks a free one.
+        - host: Interface to listen on. Defaults to the local host only.
+        Returns:
+        - The HTTP server (see ''Metrics.serve'').
+        """
+        return self.metrics.serve(port, host)
+
+
+    def share(self, name=None, size=SHM_SLOTS):
+        """
+        Publish every dump read by ''iter_dumps'' (and so by all the 
+        acquisitions) to a ''SharedRing'', for other processes to read 
+        with ''SharedRingReader''. The ring is created for the products of
+        the first acquisition, and made anew, under the same name, when an
+        acquisition reads other products.
+
+        Inputs:
+        - name: Name of the shared-memory block. Default is 
+            ''shared_name(host)'', one per board.
+        - size: Number of latest dumps held.
+        Returns:
+        - Name of the shared-memory block.
+        """
+        if name is None:
+            name = shared_name(self.host)
+        if self._share != (name, size):
+            self.unshare()
+        self._share = (name, size)
+        return name
+
+
+    def unshare(self):
+        """
+        Stop publishing the dumps and remove the shared-memory ring.
+        """
+        self._share = None
+        if self.shared is not None:
+            self.shared.close()
+            self.shared = None
+
+
+    def _shared_ring(self, shapes):
+        """
+        The ''SharedRing'' for products of ''shapes'', or None if the 
+        dumps are not shared.
+        """
+        if self._share is None:
+            return None
+        if self.shared is None or not self.shared.matches(shapes):
+            if self.shared is not None:
+                self.shared.close()
+            name, size = self._share
+            self.shared = SharedRing(shapes, size, name)
+        return self.shared
+
+
+    def dump_period(self):
+        """
+        Time between accumulation dumps [s]. This is the measured cadence
+        once dumps have been seen and the nominal value from ''acc_len'' 
+        and ''spec_per_acc'' before that.
+        """
+        if self._period is not None:
+            return self._period
+        return self.integration_time()
+
+
+    def integration_time(self):
+        """
+        Integration time of one accumulation dump [s], from ''acc_len'' 
+        and ''spec_per_acc''.
+        """
+        return self.acc_len*self.spec_per_acc*2*NCHAN/ADC_RATE
+
+
+    def reset_cnt(self):
+        """
+        Forget the last seen accumulation dump, so that the next call to
+        ''wait_for_cnt'' waits for a fresh dump. Called at the start of 
+        every acquisition.
+        """
+        self._last_cnt = None
+        self._last_dump = None
+        self._period = None
+        self.last_skipped = 0
+
+
+    def wait_for_cnt(self, timeout=None):
+        """
+        Wait for the next accumulation dump of corr_0.
+
+        The time of the next dump is predicted from the last one and the
+        dump period. The wait sleeps until just before that time and then
+        polls ''acc_cnt'' tightly, so little latency is added to each
+        integration. If dumps were missed since the previous call, it 
+        returns immediately with the latest one and the number of skipped 
+        dumps is recorded in ''last_skipped'' (and added to 
+        ''dumps_skipped'').
+
+        Inputs:
+        - timeout: Seconds to wait before raising a TimeoutError. Defaults
+            to ''wait_timeout''.
+        Returns:
+        - acc_cnt of the new dump.
+        """
+        start = time.perf_counter()
+        timeout = self._wait_timeout(timeout)
+        deadline = time.time() + timeout
+        corr = self.s.corr_0
+
+        cnt = corr.read_uint('acc_cnt')
+        target, wake, poll = self._wait_plan(cnt)
+        precise = False
+        if cnt < target:
+            if wake is not None:
+                delay = min(wake, deadline) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            cnt, precise = self._poll_cnt(target, poll, deadline, timeout)
+        cnt = self._seen_cnt(cnt, target, precise)
+        self.metrics.observe('wait_seconds', time.perf_counter() - start)
+        return cnt
+
+
+    def _poll_cnt(self, target, poll, deadline, timeout):
+        """
+        Poll the acc_cnt of corr_0 until it reaches ''target''.
+        Returns:
+        - acc_cnt read and whether the dump was seen within one poll of
+          happening.
+        """
+        corr = self.s.corr_0
+        precise = False
+        while True:
+            cnt = corr.read_uint('acc_cnt')
+            if cnt >= target:
+                return cnt, precise
+            precise = True
+            if time.time() > deadline:
+                raise TimeoutError('Timed out waiting for accumulation %d after %.2f s.' % (target, timeout))
+            time.sleep(poll)
+
+
+    def _wait_timeout(self, timeout=None):
+        """
+        Timeout of ''wait_for_cnt'' [s]: ''timeout'', else ''wait_timeout'',
+        else three dump periods plus one second.
+        """
+        if timeout is None:
+            timeout = self.wait_timeout
+        if timeout is None:
+            timeout = 3*self.dump_period() + 1.
+        return timeout
+
+
+    def _wait_plan(self, cnt):
+        """
+        Plan the wait for the dump following the last one seen, given the
+        current acc_cnt.
+        Returns:
+        - acc_cnt to wait for, time to sleep until before polling (None to
+          poll right away) and the polling interval [s].
+        """
+        period = self.dump_period()
+        if self._last_cnt is None:
+            target = cnt + 1
+        else:
+            target = self._last_cnt + 1
+        if self._last_dump is not None and self._period is not None:
+            # Sleep until just before the predicted dump, then poll tightly
+            wake = self._last_dump + (target - self._last_cnt)*period - max(WAIT_MARGIN*period, POLL_TIME)
+            return target, wake, POLL_TIME
+        # No measured cadence yet
+        return target, None, min(DELAY_TIME, period/20.)
+
+
+    def _seen_cnt(self, cnt, target, precise):
+        """
+        Record a dump seen by ''wait_for_cnt'': update the dump time, the
+        measured cadence and the skipped dumps.
+
+        Inputs:
+        - cnt: acc_cnt read.
+        - target: acc_cnt that was waited for.
+        - precise: True if the dump was seen within one poll of happening.
+        Returns:
+        - cnt
+        """
+        period = self.dump_period()
+        now = time.time()
+
+        # Update the dump time and the measured cadence
+        if self._last_dump is None:
+            dump_time = now
+        elif precise:
+            dump_time = now
+            interval = (now - self._last_dump)/(cnt - self._last_cnt)
+            if self._period is None:
+                self._period = interval
+            else:
+                self._period = (1 - PERIOD_WEIGHT)*self._period + PERIOD_WEIGHT*interval
+        else:
+            dump_time = min(now, self._last_dump + (cnt - self._last_cnt)*period)
+            if dump_time == now:
+                # The dump was already there when it was predicted to come:
+                # the cadence is overestimated, so the wake-ups would drift late
+                self._period = (now - self._last_dump)/(cnt - self._last_cnt)
+
+        self.last_skipped = cnt - target
+        if self.last_skipped > 0:
+            self.dumps_skipped += self.last_skipped
+            LOG.warning('Skipped %d accumulation dump(s) before acc_cnt %d.' % (self.last_skipped, cnt))
+        self._last_cnt = cnt
+        self._last_dump = dump_time
+        return cnt
+
+
+    @property
+    def acc_len(self):
+        """
+        Accumulation length of the correlators. Setting it updates the
+        precomputed normalization of the spectra.
+        """
+        return self._acc_len
+
+    @acc_len.setter
+    def acc_len(self, acc_len):
+        self._acc_len = acc_len
+        self._update_scale()
+
+    @property
+    def spec_per_acc(self):
+        """
+        Spectra per accumulation. Setting it updates the precomputed 
+        normalization of the spectra.
+        """
+        return self._spec_per_acc
+
+    @spec_per_acc.setter
+    def spec_per_acc(self, spec_per_acc):
+        self._spec_per_acc = spec_per_acc
+        self._update_scale()
+
+    def _update_scale(self):
+        """
+        Precompute the factor that normalizes raw accumulator values.
+        """
+        acc_len = getattr(self, '_acc_len', None)
+        spec_per_acc = getattr(self, '_spec_per_acc', None)
+        if acc_len is not None and spec_per_acc is not None:
+            self._norm = 1./float(acc_len*spec_per_acc)
 
-    def wait_for_cnt(self):
-        cnt_0 = self.s.corr_0.read_uint('acc_cnt')
-        while self.s.corr_0.read_uint('acc_cnt') < (cnt_0+1):
-            time.sleep(0.1)
-        return cnt_0
 
+    def get_new_corr(self, corr, pol1, pol2, out=None):
+        """
+        Read the latest accumulation of a correlator and normalize it.
 
-    def get_new_corr(self, corr, pol1, pol2):
+        Inputs:
+        - corr: Correlator block to read (e.g. ''self.s.corr_0'').
+        - pol1, pol2: Inputs to correlate.
+        - out: Optional preallocated array the normalized spectrum is
+            written into (real for autocorrelations, complex for cross
+            correlations), e.g. from a ''BufferRing''.
+        Returns:
+        - Normalized spectrum. Autocorrelations (pol1 == pol2) are 
+          returned as real arrays.
+        """
         corr.set_input(pol1, pol2)
-        spec = corr.read_bram(flush_vacc=False)/float(self.acc_len*self.spec_per_acc)
+        start = time.perf_counter()
+        spec = corr.read_bram(flush_vacc=False)
+        self.metrics.observe('bram_read_seconds', time.perf_counter() - start, corr=corr.name)
         if pol1 == pol2:
-            return spec.real + 1j*np.zeros(len(spec))
+            spec = spec.real
+        return np.multiply(spec, self._norm, out=out)
+
+
+    def _check_products(self, products):
+        """
+        Check a list of products (see ''read_all''), defaulting to 
+        ''default_products()''.
+        Returns:
+        - List of (name, correlator block name, (pol1, pol2)).
+        """
+        if products is None:
+            products = self.default_products()
+        blocks = [block for _, block, _ in products]
+        if len(set(blocks)) != len(blocks):
+            raise ValueError("Each correlator block can capture one product per dump: " + str(blocks))
+        return products
+
+
+    def _select_products(self, products):
+        """
+        Select the inputs of the correlator blocks for a list of products
+        (see ''_check_products'').
+        Returns:
+        - List of (name, correlator block, autocorrelation flag).
+        """
+        products = self._check_products(products)
+        reads = []
+        for name, block, (pol1, pol2) in products:
+            corr = getattr(self.s, block)
+            corr.set_input(pol1, pol2)
+            reads.append((name, corr, pol1 == pol2))
+        return reads
+
+
+    def _read_products(self, reads, data, pool=None):
+        """
+        Read the BRAMs of the selected products of the current dump and
+        normalize them into the arrays of ''data''. The blocks are read
+        concurrently if a thread ''pool'' is given.
+        """
+        def read(item):
+            name, corr, auto = item
+            start = time.perf_counter()
+            spec = corr.read_bram(flush_vacc=False)
+            self.metrics.observe('bram_read_seconds', time.perf_counter() - start, corr=corr.name)
+            np.multiply(spec.real if auto else spec, self._norm, out=data[name])
+
+        if pool is not None:
+            list(pool.map(read, reads))
         else:
-            return spec
+            for item in reads:
+                read(item)
+
+
+    def _start_dumps(self, products, reset=True, dump_stats=None):
+        """
+        Start a loop over the dumps (''iter_dumps'' and its asynchronous
+        version): select the products, set up the dump accounting and the
+        shared ring, and optionally start from a fresh dump.
+        Returns:
+        - Selected products (see ''_select_products''), dictionary of the
+          (shape, dtype) of their spectra, the ''DumpStats'' recording the
+          dumps and the ''SharedRing'' (None if the dumps are not shared).
+        """
+        reads = self._select_products(products)
+        shapes = dict((name, ((NCHAN,), float if auto else complex)) for name, _, auto in reads)
+        if dump_stats is None:
+            dump_stats = DumpStats(self.metrics)
+            self.dump_stats = dump_stats
+        shared = self._shared_ring(shapes)
+        if reset:
+            self.reset_cnt()
+        return reads, shapes, dump_stats, shared
+
+
+    def _record_dump(self, cnt_0, cnt_1, unix, data, dump_stats, shared=None):
+        """
+        Account for a dump read by a loop started with ''_start_dumps''
+        and publish it to ''shared''.
+
+        Inputs:
+        - cnt_0, cnt_1: acc_cnt of corr_0 (from ''wait_for_cnt'') and of
+            corr_1, read after the BRAMs.
+        - unix: Time the dump was seen.
+        - data: Dictionary of the spectra of each product.
+        - dump_stats, shared: See ''_start_dumps''.
+        Returns:
+        - Dump record yielded by ''iter_dumps''.
+        """
+        dump = dump_stats.record(cnt_0, cnt_1, self.last_skipped, unix)
+        if shared is not None:
+            shared.write(data, dump)
+        dump['data'] = data
+        return dump
+
+
+    def iter_dumps(self, nspec=None, products=None, parallel=True, threaded=False, nbuffers=NBUFFERS, 
+                   reset=True, dump_stats=None):
+        """
+        Generator of the accumulation dumps as they arrive, without 
+        writing them to disk. Acquisitions such as ''read_spec'' and 
+        ''read_all'' consume it, and so can live averaging or RFI checks:
+
+            for dump in spec.iter_dumps(100):
+                print(dump['acc_cnt'], dump['data']['auto0'].mean())
+
+        The arrays are taken from a fixed set of ''nbuffers'' buffers per
+        product and are reused afterwards, so a consumer must copy any 
+        spectrum it keeps for longer than the following ''nbuffers'' - 1
+        dumps (or, if ''threaded'', longer than until the next one). 
+        Stopping the iteration early (''break'' or ''close()'') ends the 
+        acquisition cleanly.
+
+        Inputs:
+        - nspec: Number of dumps to yield. None (default) runs until the
+            consumer stops.
+        - products: List of (name, correlator block name, (pol1, pol2)), at
+            most one per block. Default is ''default_products()''.
+        - parallel: If True (default), read the blocks from a thread pool.
+        - threaded: If True, read the BRAMs on a background thread that
+            stays ahead of the consumer by up to ''nbuffers'' dumps. If 
+            the consumer falls further behind, dumps are dropped rather 
+            than delaying the readout. Counters of the queue are kept in 
+            ''self.pipeline''.
+        - nbuffers: Number of buffers per product.
+        - reset: If True (default), start from a fresh dump (see 
+            ''reset_cnt''). Otherwise continue from the last dump seen.
+        - dump_stats: ''DumpStats'' recording the dumps. By default a new
+            one, kept in ''self.dump_stats''.
+        Yields:
+        - Dictionary per dump with ''acc_cnt'', ''acc_cnt1'', ''unix'' 
+          (time the dump was seen), ''gap'' and ''desync'' (see 
+          ''DumpStats.record'') and ''data'', a dictionary of the 
+          normalized spectra of each product: real arrays for 
+          autocorrelations and complex arrays for cross correlations.
+          If the dumps are shared (see ''share''), each one is also 
+          copied to shared memory as soon as it is read.
+        """
+        reads, shapes, dump_stats, shared = self._start_dumps(products, reset, dump_stats)
+        pool = None
+        if parallel and len(reads) > 1:
+            pool = ThreadPoolExecutor(max_workers=len(reads))
+        try:
+            if threaded:
+                for dump in self._iter_dumps_threaded(reads, shapes, nspec, nbuffers, dump_stats, pool, shared):
+                    yield dump
+                return
+            rings = dict((name, BufferRing(nbuffers, shape, dtype)) for name, (shape, dtype) in shapes.items())
+            debug = LOG.isEnabledFor(logging.DEBUG) # keep debug calls out of the loop unless enabled
+            ninteg = 0
+            while nspec is None or ninteg < nspec:
+                cnt_0 = self.wait_for_cnt()
+                unix = time.time()
+                data = dict((name, ring.next()) for name, ring in rings.items())
+                self._read_products(reads, data, pool)
+                cnt_1 = self.s.corr_1.read_uint('acc_cnt')
+                if debug:
+                    LOG.debug('Integration %d: acc_cnt %d/%d.', ninteg, cnt_0, cnt_1)
+                ninteg += 1
+                yield self._record_dump(cnt_0, cnt_1, unix, data, dump_stats, shared)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+
+    def _iter_dumps_threaded(self, reads, shapes, nspec, nbuffers, dump_stats, pool, shared=None):
+        """
+        ''iter_dumps'' with the BRAMs read on a background thread, which
+        hands them to the consumer through an ''AcquisitionPipeline'' and
+        publishes them to ''shared''.
+        """
+        self.pipeline = pipeline = AcquisitionPipeline(shapes, nbuffers=nbuffers)
+        stop = threading.Event()
+        debug = LOG.isEnabledFor(logging.DEBUG) # keep debug calls out of the loop unless enabled
+
+        def produce():
+            try:
+                while not stop.is_set() and (nspec is None or pipeline.nread < nspec):
+                    cnt_0 = self.wait_for_cnt()
+                    if debug:
+                        LOG.debug('Read acc_cnt %d.', cnt_0)
+                    unix = time.time()
+                    buffers = pipeline.get_buffers()
+                    if buffers is None:
+                        LOG.warning('Consumer fell behind, dropped dump %d.' % cnt_0)
+                        dump_stats.drop()
+                        continue
+                    self._read_products(reads, buffers, pool)
+                    cnt_1 = self.s.corr_1.read_uint('acc_cnt')
+                    pipeline.put(buffers, self._record_dump(cnt_0, cnt_1, unix, buffers, dump_stats, shared))
+            except Exception as e:
+                pipeline.abort(e)
+            else:
+                pipeline.stop()
+
+        reader = threading.Thread(target=produce, name='leuschner-reader')
+        reader.daemon = True
+        reader.start()
+        buffers = None
+        try:
+            while True:
+                if buffers is not None:
+                    pipeline.release(buffers)
+                item = pipeline.get()
+                if item is None:
+                    break
+                buffers, dump = item
+                dump['data'] = buffers
+                yield dump
+        finally:
+            stop.set()
+            reader.join()
+            LOG.info('Acquisition pipeline: %(nread)d read, %(nwritten)d consumed, '
+                     '%(dropped)d dropped, max queue depth %(max_depth)d.' % pipeline.stats())
+
+
+    def _columns(self, data):
+        """
+        FITS columns of the spectra of a dump: ''<name>_real'' and, for
+        cross correlations, ''<name>_imag''.
+        """
+        columns = {}
+        for name, array in data.items():
+            if np.iscomplexobj(array):
+                columns[name+'_real'] = array.real
+                columns[name+'_imag'] = array.imag
+            else:
+                columns[name+'_real'] = array
+        return columns
 
 
-    def read_spec(self, filename, nspec, coords, coord_sys='ga'):
+    def read_spec(self, filename, nspec, coords, coord_sys='ga', layout='hdu', stream=True, flush_every=1, 
+                  threaded=False, nbuffers=NBUFFERS, navg=1, reduce='mean', reduce_stats=False, 
+                  encoding='float64', compress=None, checkpoint_every=None, times=None):
         """
         Recieves spectrometer data from the Leuschner spectrometer and 
         saves it to a FITS file. The primary HDU contains information about
         the observation (coordinates, number of spectra collected, time,
-        etc.) and spectrometer attributes used. Each set of spectra is
-        stored in its own FITS table in the FITS file. The columns in
-        each FITS table are ''auto0_real'', ''auto1_real'',
-        ''cross_real'', and ''cross_imag''. All columns contain
-        double-precision floating-point numbers.
+        etc.) and spectrometer attributes used. By default each set of 
+        spectra is stored in its own FITS table in the FITS file. The 
+        columns in each FITS table are ''auto0_real'' and ''auto1_real''.
+        All columns contain double-precision floating-point numbers.
 
         Inputs:
         - filename: Name of the output FITs file.
@@ -240,45 +3022,265 @@ class Spectrometer(object):
         - coord_sys: Coordinate system used for ''coords''.
             Default is galactic coordinates. Takes in either galactic 
             ('ga') or equatorial ('eq') coordinate systems.
+        - layout: Output layout. 'hdu' (default) stores one table per
+            integration. 'table' stores a single table with one row per
+            integration, with ''auto0_real''/''auto1_real'' as 1024D 
+            vector columns plus per-integration metadata columns.
+        - stream: If True (default), write each integration to the file
+            as it is read so memory use stays flat and the file is valid
+            if the run is interrupted. If False, hold all integrations in
+            memory and write them once at the end.
+        - flush_every: Number of integrations buffered between writes
+            when streaming.
+        - threaded: If True, read the BRAMs on a background thread that
+            hands them to this one through an ''AcquisitionPipeline'' (see
+            ''iter_dumps''), so that FITS serialization and disk I/O do 
+            not delay the next read. Counters of the run are kept in 
+            ''self.pipeline''.
+        - nbuffers: Number of preallocated buffers (queue depth) used
+            when ''threaded'' is True.
+        - navg: Number of consecutive dumps combined on the host into each
+            stored spectrum (see ''Accumulator''). Default 1 stores every
+            dump.
+        - reduce: How dumps are combined, 'mean' (default) or 'sum'.
+        - reduce_stats: If True, also store the per-channel variance, 
+            minimum and maximum of the combined dumps.
+        - encoding: Storage of the spectra: 'float64' (default), 'float32'
+            or 'int' for the raw integer accumulator values with the 
+            normalization in the TSCALn keyword (see ''FitsStreamWriter'').
+            Raw dumps are stored as 32-bit integers. With ''navg'' > 1, 
+            'int' requires ''reduce'' 'sum', and the sums are stored as 
+            64-bit integers (recorded in the INTFMT keyword).
+        - compress: None (default), or 'gzip' to compress the file to 
+            ''filename''.gz once it is complete.
+        - checkpoint_every: If set, make the file durable every this many
+            stored spectra, with a manifest ''filename''.ckpt of what it 
+            holds (see ''FitsStreamWriter''). If ''filename'' has a 
+            checkpoint, e.g. because the connection dropped or the host 
+            rebooted during an earlier run with the same arguments, the 
+            SNAP is reconnected and the acquisition resumes, appending 
+            the remaining spectra to the file. Requires ''stream''.
+        - times: Whether to append a TIMES table with the host, 
+            FPGA-derived, JD and LST times of every integration (see 
+            ''FitsStreamWriter''). Default None does so for the 'table' 
+            layout only, so that every extension of an 'hdu' file stays
+            an integration.
         Returns:
-        - FITS file with autocorrelated spectrometer data.
+        - FITS file with autocorrelated spectrometer data. Each integration
+          records ''acc_cnt'' and ''acc_cnt1'' (the counts of corr_0 and 
+          corr_1), ''gap'' (dumps missing before it), ''desync'' and 
+          ''unix'', and the primary header records NMISSED, NDESYNC and 
+          NRESUME.
+        - Summary of missed dumps and desyncs (see ''DumpStats'').
         """
-        # Make PrimaryHDU for FITS file
-        primaryhdu = self.make_PrimaryHDU(nspec, coords, coord_sys)
-        hdulist = fits.HDUList(hdus=[primaryhdu])
+        self.dump_stats = DumpStats(self.metrics)
+        resume = self._resume(filename, checkpoint_every)
+        writer = self._open_writer(filename, nspec, coords, coord_sys, layout, stream, flush_every, 
+                                   navg, reduce, reduce_stats, encoding, compress, 
+                                   checkpoint_every=checkpoint_every, resume=resume, times=times)
+        complete = False
+        try:
+            self.reset_cnt()
+            self._acquire(writer, nspec - self.dump_stats.nspec, threaded, nbuffers)
+            complete = True
+        finally:
+            self._close_writer(writer, complete=complete)
+        return self.dump_stats.summary()
+
+
+    def _acquire(self, writer, nspec, threaded=False, nbuffers=NBUFFERS):
+        """
+        Acquisition loop of ''read_spec'': write ''nspec'' integrations of 
+        both autocorrelations from ''iter_dumps'' to ''writer'', recording
+        them in ''self.dump_stats''. Dumps are counted from the last one 
+        seen by ''wait_for_cnt'' (see ''reset_cnt'').
+        """
+        for dump in self.iter_dumps(nspec, self.default_products(), parallel=False, threaded=threaded, nbuffers=nbuffers,
+                                    reset=False, dump_stats=self.dump_stats):
+            data = dump.pop('data')
+            writer.write(self._columns(data), meta=dump)
+
+
+    def _resume(self, filename, checkpoint_every):
+        """
+        Prepare to resume an acquisition into ''filename'' from its last
+        checkpoint, if checkpoints are enabled and it has one: restore 
+        the dump accounting into ''self.dump_stats'' and reconnect to the
+        SNAP.
+        Returns:
+        - True if the acquisition resumes.
+        """
+        if checkpoint_every is None:
+            return False
+        manifest = read_manifest(filename)
+        if manifest is None:
+            return False
+        LOG.warning('Resuming %s from its checkpoint of %s: %d dumps already written.' % (
+            filename, time.ctime(manifest['unix']), manifest['ndumps']))
+        restarted = self.reconnect()
+        self.dump_stats.restore(manifest.get('state'), manifest['ndumps'], continuous=not restarted)
+        return True
+
+
+    def _make_header(self, nspec, coords, coord_sys='ga', navg=1, reduce='mean', obs_start_unix=None):
+        """
+        Make the PrimaryHDU of an acquisition, with placeholders for the
+        dump summary.
+        """
+        primaryhdu = self.headers.make_PrimaryHDU(nspec, coords, coord_sys, obs_start_unix)
+        header = primaryhdu.header
+        header['NMISSED'] = (0, "Accumulation dumps missed")
+        header['NDESYNC'] = (0, "Integrations with desynced correlators")
+        header['NRESUME'] = (0, "Times the acquisition was resumed")
+        header['NAVG'] = (navg, "Dumps combined per stored spectrum")
+        header['REDUCE'] = (reduce, "How dumps are combined on the host")
+        header['INTTIME'] = (navg*self.integration_time(), "Effective integration time [s]")
+        return primaryhdu
+
+
+    def _open_writer(self, filename, nspec, coords, coord_sys, layout, stream, flush_every, 
+                     navg=1, reduce='mean', reduce_stats=False, encoding='float64', compress=None, 
+                     primaryhdu=None, checkpoint_every=None, resume=False, times=None):
+        """
+        Open the output file of an acquisition, with an ''Accumulator'' in
+        front of the writer if ''navg'' > 1. The PrimaryHDU is made with
+        ''_make_header'' unless one is given or the file is resumed. The
+        checkpoints record the summary of ''self.dump_stats'', and the 
+        dumps are timestamped (if ''times'', see ''FitsStreamWriter'') 
+        with the integration time and location of the spectrometer.
+        """
+        if checkpoint_every is not None and not stream:
+            raise ValueError("Checkpoints require a streamed acquisition (stream=True).")
+        if encoding == 'int' and navg > 1 and reduce == 'mean':
+            raise ValueError("The 'int' encoding would round the mean of the dumps, use reduce='sum'.")
+        if primaryhdu is None and not resume:
+            primaryhdu = self._make_header(nspec, coords, coord_sys, navg, reduce)
+        if not stream:
+            flush_every = max(nspec, 1)
+        checkpoint_state = self.dump_stats.summary if checkpoint_every is not None else None
+        # Sums of dumps may need more than the 32 bits of a raw dump
+        max_units = navg*(INT_LIMITS['J'] - 1) if reduce == 'sum' and navg > 1 else None
+        location = self.location
+        if location is None:
+            location = observatory_location # only needed, and loaded, when the file is closed
+        writer = FitsStreamWriter(filename, primaryhdu, layout=layout, flush_every=flush_every, metrics=self.metrics,
+                                  encoding=encoding, scale=self._norm, compress=compress, 
+                                  checkpoint_every=checkpoint_every, checkpoint_state=checkpoint_state, 
+                                  resume=resume, integration_time=self.integration_time(), location=location,
+                                  times=times, max_units=max_units)
+        if navg > 1 or reduce_stats:
+            writer = Accumulator(writer, navg, mode=reduce, stats=reduce_stats)
+        return writer
+
+
+    def _close_writer(self, writer, dump_stats=None, complete=True):
+        """
+        Record the dump summary (by default of ''self.dump_stats'') in the
+        primary header and close the output file of an acquisition. A 
+        file whose acquisition did not ''complete'' keeps its checkpoint.
+        """
+        if dump_stats is None:
+            dump_stats = self.dump_stats
+        dump_stats.log()
+        writer.update_header('NMISSED', dump_stats.summary()['missed'])
+        writer.update_header('NDESYNC', dump_stats.desyncs)
+        writer.close(complete)
 
-        # Define spectra to collect
-        spectra = [('auto0_real', self.s.corr_0, (self.stream_1, self.stream_1)), # (0, 0)
-                   ('auto1_real', self.s.corr_1, (self.stream_2, self.stream_2))] # (1, 1)
-        data = {}
-        
-        for ninteg in range(nspec):
-            cnt_0 = self.wait_for_cnt()
-            for name, corr, (stream_1, stream_2) in spectra: # read the spectra from both corrs
-                data[name] = self.get_new_corr(corr, stream_1, stream_2).real
-            cnt_1 = self.s.corr_1.read_uint('acc_cnt')
-            assert cnt_0 + 1 == cnt_1 # assert corr_0's count increased and matches corr_1's count
 
-            # Make BinTableHDU and append collected data
-            data_list = [fits.Column(name=name, format='D', array=data[name]) for name, _, _ in spectra]
-            bintablehdu = fits.BinTableHDU.from_columns(data_list, name='CORR_DATA')
-            hdulist.append(bintablehdu)
-           
-        # Save the output file
-        hdulist.writeto(filename, overwrite=True)
-        hdulist.close()
+    def scan(self, pointings, layout='hdu', flush_every=1, threaded=False, nbuffers=NBUFFERS, 
+             navg=1, reduce='mean', reduce_stats=False, encoding='float64', compress=None, times=None):
+        """
+        Observe a list of pointings one after the other, each into its own
+        FITS file like ''read_spec''.
+
+        The headers of all pointings are made before the first one starts,
+        with the coordinates converted in one batch (see 
+        ''HeaderFactory.precompute''), and every file is finalized and 
+        closed on a background thread while the next pointing is acquired.
+        A pointing without a start time continues from the last dump of 
+        the previous one, so the dumps lost in between are counted.
+
+        Inputs:
+        - pointings: List of dictionaries with the ''filename'', ''coords''
+            and ''nspec'' of each pointing, and optionally its ''coord_sys''
+            (default 'ga') and ''start'' (unix time to wait for before 
+            starting it).
+        - layout, flush_every, threaded, nbuffers, navg, reduce, 
+            reduce_stats, encoding, compress, times: See ''read_spec''. 
+            Compression runs on the background thread.
+        Returns:
+        - List with the summary of each pointing (see ''DumpStats'') plus
+          its ''filename'', the time spent waiting for its ''start'' 
+          (''wait'') and the ''dead_time'' [s] and ''dead_dumps'' between 
+          the last integration of the previous pointing and its first 
+          one, not counting the wait. ''dead_dumps'' is None for the first
+          pointing and after a wait.
+        """
+        # Make all headers up front
+        systems = [pointing.get('coord_sys', 'ga') for pointing in pointings]
+        for coord_sys in set(systems):
+            self.headers.precompute([pointing['coords'] for pointing, cs in zip(pointings, systems) 
+                                     if cs == coord_sys], coord_sys)
+        headers = [self._make_header(pointing['nspec'], pointing['coords'], cs, navg, reduce) 
+                   for pointing, cs in zip(pointings, systems)]
+
+        closer = ThreadPoolExecutor(max_workers=1) # finalizes the files in the background
+        closing = []
+        results = []
+        previous = None
+        try:
+            self.reset_cnt()
+            for i, (pointing, primaryhdu) in enumerate(zip(pointings, headers)):
+                # Wait for the start time
+                wait = 0.
+                if pointing.get('start') is not None:
+                    wait = max(pointing['start'] - time.time(), 0.)
+                    if wait > 0:
+                        LOG.info('Waiting %.1f s to start %s.' % (wait, pointing['filename']))
+                        time.sleep(wait)
+                        self.reset_cnt()
+                    else:
+                        LOG.warning('Starting %s %.1f s late.' % (pointing['filename'], time.time() - pointing['start']))
 
+                self.headers.set_start(primaryhdu.header)
+                writer = self._open_writer(pointing['filename'], pointing['nspec'], pointing['coords'], systems[i],
+                                           layout, True, flush_every, navg, reduce, reduce_stats, 
+                                           encoding, compress, primaryhdu=primaryhdu, times=times)
+                self.dump_stats = dump_stats = DumpStats(self.metrics)
+                try:
+                    self._acquire(writer, pointing['nspec'], threaded, nbuffers)
+                finally:
+                    closing.append(closer.submit(self._close_writer, writer, dump_stats))
 
-    def read_corr(self, filename, nspec, coords, coord_sys='ga'):
+                # Dead time since the previous pointing
+                result = dump_stats.summary()
+                result.update({'filename': pointing['filename'], 'wait': wait, 
+                               'dead_time': None, 'dead_dumps': None})
+                if previous is not None and previous['last_unix'] is not None and result['first_unix'] is not None:
+                    result['dead_time'] = result['first_unix'] - previous['last_unix'] - wait
+                    if wait == 0:
+                        result['dead_dumps'] = result['first_cnt'] - previous['last_cnt'] - 1
+                    LOG.info('Pointing %d of %d: dead time %.3f s (%s dumps).' % (
+                        i + 1, len(pointings), result['dead_time'], result['dead_dumps']))
+                results.append(result)
+                previous = result
+        finally:
+            closer.shutdown(wait=True)
+        for future in closing:
+            future.result() # raise errors of the background writes
+        return results
+
+
+    def read_corr(self, filename, nspec, coords, coord_sys='ga', layout='hdu', stream=True, flush_every=1,
+                  encoding='float64', compress=None, checkpoint_every=None, times=None):
         """
         Recieves correlation data from the Leuschner spectrometer and 
         saves it to a FITS file. The primary HDU contains information about
         the observation (coordinates, number of spectra collected, time,
-        etc.) and spectrometer attributes used. Each set of spectra is
-        stored in its own FITS table in the FITS file. The columns in
-        each FITS table are ''auto0_real'', ''auto1_real'',
-        ''cross_real'', and ''cross_imag''. All columns contain
-        double-precision floating-point numbers.
+        etc.) and spectrometer attributes used. By default each set of 
+        spectra is stored in its own FITS table in the FITS file. The 
+        columns in each FITS table are ''cross_real'' and ''cross_imag''.
+        All columns contain double-precision floating-point numbers.
 
         Inputs:
         - filename: Name of the output FITs file.
@@ -288,28 +3290,85 @@ class Spectrometer(object):
         - coord_sys: Coordinate system used for ''coords''.
             Default is galactic coordinates. Takes in either galactic 
             ('ga') or equatorial ('eq') coordinate systems.
+        - layout: Output layout, either 'hdu' (default) or 'table'.
+            See ''read_spec''.
+        - stream: If True (default), write each integration to the file
+            as it is read. If False, write them once at the end.
+        - flush_every: Number of integrations buffered between writes
+            when streaming.
+        - encoding, compress: Storage of the spectra and compression of 
+            the file. See ''read_spec''.
+        - checkpoint_every, times: Checkpoints for resuming an interrupted
+            run and TIMES table. See ''read_spec''.
         Returns:
         - FITS file with correlated spectrometer data.
+        - Summary of missed dumps and desyncs (see ''DumpStats'').
+        """
+        products = [('cross', 'corr_0', (self.stream_1, self.stream_2))] # (0, 1)
+        return self.read_all(filename, nspec, coords, coord_sys, products=products, layout=layout, 
+                             stream=stream, flush_every=flush_every, encoding=encoding, compress=compress,
+                             checkpoint_every=checkpoint_every, times=times)
+
+
+    def default_products(self):
+        """
+        Products captured by ''read_spec'', and by ''read_all'' by 
+        default: the autocorrelation of each stream, one on each 
+        correlator block.
+        Returns:
+        - List of (name, correlator block name, (pol1, pol2)).
+        """
+        return [('auto0', 'corr_0', (self.stream_1, self.stream_1)), # (0, 0)
+                ('auto1', 'corr_1', (self.stream_2, self.stream_2))] # (1, 1)
+
+
+    def read_all(self, filename, nspec, coords, coord_sys='ga', products=None, layout='hdu', stream=True, 
+                 flush_every=1, parallel=True, navg=1, reduce='mean', reduce_stats=False, encoding='float64', 
+                 compress=None, checkpoint_every=None, times=None):
+        """
+        Recieves all requested products of every accumulation dump from 
+        both correlator blocks and saves them to a FITS file. For each 
+        dump, the BRAMs of the blocks are read concurrently and all 
+        products are tagged with the same ''acc_cnt''. The dumps are taken
+        from ''iter_dumps''.
+
+        Each correlator block has a single output BRAM holding the product
+        selected with ''set_input'', so every block can deliver one 
+        product per dump. The inputs are selected once before the loop.
+
+        Inputs:
+        - filename: Name of the output FITs file.
+        - nspec: Number of spectra to collect.
+        - coords: Coordinate(s) of the target.
+            Format: (l/ra, b/dec)
+        - coord_sys: Coordinate system used for ''coords''.
+            Default is galactic coordinates. Takes in either galactic 
+            ('ga') or equatorial ('eq') coordinate systems.
+        - products: List of (name, correlator block name, (pol1, pol2)), at
+            most one per block. Default is ''default_products()''. E.g. 
+            [('auto0', 'corr_0', (0, 0)), ('cross', 'corr_1', (0, 1))].
+        - layout, stream, flush_every, navg, reduce, reduce_stats, encoding,
+            compress, checkpoint_every, times: See ''read_spec''.
+        - parallel: If True (default), read the blocks from a thread pool.
+        Returns:
+        - FITS file with columns ''<name>_real'' for autocorrelations and
+          ''<name>_real''/''<name>_imag'' for cross correlations.
+        - Summary of missed dumps and desyncs (see ''DumpStats'').
         """
-        primaryhdu = self.make_PrimaryHDU(nspec, coords, coord_sys)
-        hdulist = fits.HDUList(hdus=[primaryhdu])
-
-        # Read some number of spectra to a FITS file
-        ninteg = 0
-        while ninteg < nspec:
-            spectra = [('cross', (self.stream_1, self.stream_2))] # (0, 1)
-            data_list = []
-            for name, (stream_1, stream_2) in spectra:
-                cross = self.s.corr_0.get_new_corr(stream_1, stream_2)
-                cross_real, cross_imag = cross.real, cross.imag
-            
-            data_list.append(fits.Column(name=name+'_real', format='D', array=cross_real))
-            data_list.append(fits.Column(name=name+'_imag', format='D', array=cross_imag))
-
-            bintablehdu = fits.BinTableHDU.from_columns(data_list, name='CORR_DATA')
-            hdulist.append(bintablehdu)
-            ninteg += 1
- 
-        # Save the output file
-        hdulist.writeto(filename, overwrite=True)
-        hdulist.close()
+        products = self._check_products(products) # before the file is opened
+
+        self.dump_stats = DumpStats(self.metrics)
+        resume = self._resume(filename, checkpoint_every)
+        writer = self._open_writer(filename, nspec, coords, coord_sys, layout, stream, flush_every, 
+                                   navg, reduce, reduce_stats, encoding, compress, 
+                                   checkpoint_every=checkpoint_every, resume=resume, times=times)
+        complete = False
+        try:
+            for dump in self.iter_dumps(nspec - self.dump_stats.nspec, products, parallel=parallel, 
+                                        dump_stats=self.dump_stats):
+                data = dump.pop('data')
+                writer.write(self._columns(data), meta=dump)
+            complete = True
+        finally:
+            self._close_writer(writer, complete=complete)
+        return self.dump_stats.summary()
@@ -0,0 +1,237 @@
+"""
+asyncio interface to the SNAP spectrometer, to run one or several boards
+from a single event loop:
+
+    import asyncio
+    from leuschner_async import AsyncSpectrometer, SpectrometerArray
+
+    async def main():
+        boards = SpectrometerArray([AsyncSpectrometer(host=host) for host in hosts])
+        await boards.initialize()
+        async for group in boards.iter_dumps(100):
+            print(group['unix'], [dump['acc_cnt'] for dump in group['dumps']])
+
+    asyncio.run(main())
+
+The register and BRAM reads of casperfpga are blocking, so every board
+runs them on its own small thread pool. The waits between dumps are
+asyncio sleeps, so a waiting board does not hold a thread and the boards
+wait for their dumps concurrently.
+"""
+
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import leuschner
+from leuschner import NBUFFERS, BufferRing, LOG
+
+
+class AsyncSpectrometer(object):
+    """
+    Coroutine interface to one Spectrometer. The dump timing (see
+    ''Spectrometer.wait_for_cnt''), dump accounting and metrics are
+    shared with the wrapped Spectrometer.
+    """
+
+    def __init__(self, spectrometer=None, **kwargs):
+        """
+        Inputs:
+        - spectrometer: Spectrometer to drive. By default one is created
+            from the keyword arguments (see ''leuschner.Spectrometer'').
+        """
+        if spectrometer is None:
+            spectrometer = leuschner.Spectrometer(**kwargs)
+        self.spec = spectrometer
+        # One worker per correlator block, so both BRAMs can be read at once
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='leuschner-%s' % spectrometer.host)
+
+    async def _call(self, func, *args, **kwargs):
+        """
+        Run a blocking call on this board's thread pool.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def initialize(self, **kwargs):
+        """
+        Program and initialize the board. See ''Spectrometer.initialize''.
+        """
+        return await self._call(self.spec.initialize, **kwargs)
+
+    async def wait_for_cnt(self, timeout=None):
+        """
+        Wait for the next accumulation dump of corr_0, like
+        ''Spectrometer.wait_for_cnt''. The sleep until just before the 
+        predicted dump is an asyncio sleep.
+        Returns:
+        - acc_cnt of the new dump.
+        """
+        spec = self.spec
+        start = time.perf_counter()
+        timeout = spec._wait_timeout(timeout)
+        deadline = time.time() + timeout
+        corr = spec.s.corr_0
+
+        cnt = await self._call(corr.read_uint, 'acc_cnt')
+        target, wake, poll = spec._wait_plan(cnt)
+        precise = False
+        if cnt < target:
+            if wake is not None:
+                delay = min(wake, deadline) - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            # The tight polling just before the dump runs on the pool, with
+            # the same latency as the synchronous wait
+            cnt, precise = await self._call(spec._poll_cnt, target, poll, deadline, timeout)
+        cnt = spec._seen_cnt(cnt, target, precise)
+        spec.metrics.observe('wait_seconds', time.perf_counter() - start)
+        return cnt
+
+    async def get_new_corr(self, corr, pol1, pol2, out=None):
+        """
+        Read and normalize the latest accumulation of a correlator. See
+        ''Spectrometer.get_new_corr''.
+        """
+        return await self._call(self.spec.get_new_corr, corr, pol1, pol2, out=out)
+
+    async def read_products(self, reads, data):
+        """
+        Read the BRAMs of the selected products (see
+        ''Spectrometer._select_products'') concurrently and normalize
+        them into the arrays of ''data''.
+        """
+        await asyncio.gather(*[self._call(self.spec._read_products, [item], data) for item in reads])
+
+    async def iter_dumps(self, nspec=None, products=None, nbuffers=NBUFFERS, reset=True, dump_stats=None):
+        """
+        Asynchronous generator of the accumulation dumps, yielding the
+        same records as ''Spectrometer.iter_dumps'', and publishing them
+        to shared memory if the Spectrometer shares its dumps. The arrays
+        are reused after ''nbuffers'' dumps.
+        """
+        spec = self.spec
+        reads, shapes, dump_stats, shared = await self._call(spec._start_dumps, products, reset, dump_stats)
+        rings = dict((name, BufferRing(nbuffers, shape, dtype)) for name, (shape, dtype) in shapes.items())
+        ninteg = 0
+        while nspec is None or ninteg < nspec:
+            cnt_0 = await self.wait_for_cnt()
+            unix = time.time()
+            data = dict((name, ring.next()) for name, ring in rings.items())
+            await self.read_products(reads, data)
+            cnt_1 = await self._call(spec.s.corr_1.read_uint, 'acc_cnt')
+            ninteg += 1
+            yield spec._record_dump(cnt_0, cnt_1, unix, data, dump_stats, shared)
+
+    def close(self):
+        """
+        Shut down the board's thread pool.
+        """
+        self._executor.shutdown(wait=False)
+
+
+class SpectrometerArray(object):
+    """
+    Runs several AsyncSpectrometers concurrently from one event loop and
+    groups their dumps by time. The boards need not be synchronized: 
+    dumps less than ''tolerance'' apart are matched. A board that missed
+    a dump is a whole dump period ahead of the others, so the dumps of 
+    the other boards without a match are discarded and counted in 
+    ''unmatched''.
+    Boards with free-running accumulation clocks can have dump phases
+    spread over more than ''tolerance''; they should be started from a
+    common sync pulse for all their dumps to be matched.
+    """
+
+    def __init__(self, spectrometers, tolerance=None):
+        """
+        Inputs:
+        - spectrometers: List of AsyncSpectrometers.
+        - tolerance: Largest difference of the dump times within a group
+            [s]. Defaults to 0.9 times the shortest dump period.
+        """
+        self.spectrometers = list(spectrometers)
+        self.tolerance = tolerance
+        self.unmatched = [0]*len(self.spectrometers)
+
+    async def initialize(self, **kwargs):
+        """
+        Initialize all boards concurrently.
+        Returns:
+        - List of the results of ''Spectrometer.initialize''.
+        """
+        return await asyncio.gather(*[board.initialize(**kwargs) for board in self.spectrometers])
+
+    async def _produce(self, board, dumps, products, nbuffers):
+        """
+        Put the dumps of one board on its queue, with a copy of the
+        spectra so they stay valid while they wait to be matched. Errors
+        are put on the queue for the consumer to raise.
+        """
+        try:
+            async for dump in board.iter_dumps(None, products, nbuffers):
+                dump['data'] = dict((name, array.copy()) for name, array in dump['data'].items())
+                await dumps.put(dump)
+        except Exception as e:
+            await dumps.put(e)
+
+    async def _next(self, dumps):
+        item = await dumps.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    async def iter_dumps(self, nspec=None, products=None, nbuffers=NBUFFERS):
+        """
+        Asynchronous generator of the dumps of all boards, matched by
+        time.
+
+        Inputs:
+        - nspec: Number of groups to yield. None (default) runs until the
+            consumer stops.
+        - products: Products read from every board (see
+            ''Spectrometer.iter_dumps'').
+        - nbuffers: Number of dumps queued per board.
+        Yields:
+        - Dictionary per group with ''unix'', the mean dump time, and
+          ''dumps'', the records of the boards in order (see
+          ''Spectrometer.iter_dumps'').
+        """
+        queues = [asyncio.Queue(maxsize=nbuffers) for board in self.spectrometers]
+        tasks = [asyncio.ensure_future(self._produce(board, dumps, products, nbuffers))
+                 for board, dumps in zip(self.spectrometers, queues)]
+        try:
+            heads = [await self._next(dumps) for dumps in queues]
+            ngroup = 0
+            while nspec is None or ngroup < nspec:
+                tolerance = self.tolerance
+                if tolerance is None:
+                    tolerance = 0.9*min(board.spec.dump_period() for board in self.spectrometers)
+                newest = max(dump['unix'] for dump in heads)
+                late = [i for i, dump in enumerate(heads) if dump['unix'] < newest - tolerance]
+                if late:
+                    # Drop the dumps without a match and take the next ones
+                    for i in late:
+                        self.unmatched[i] += 1
+                        heads[i] = await self._next(queues[i])
+                    continue
+                yield {'unix': float(np.mean([dump['unix'] for dump in heads])), 'dumps': list(heads)}
+                ngroup += 1
+                if nspec is None or ngroup < nspec:
+                    heads = [await self._next(dumps) for dumps in queues]
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if any(self.unmatched):
+                LOG.warning('Dumps without a match on the other boards: %s' % self.unmatched)
+
+    def close(self):
+        """
+        Shut down the thread pools of all boards.
+        """
+        for board in self.spectrometers:
+            board.close()
@@ -0,0 +1,339 @@
+"""
+In-process simulation of the SNAP spectrometer, used as a Spectrometer
+backend so that acquisition code can be run and benchmarked without the
+hardware:
+
+    from leuschner import Spectrometer
+    spec = Spectrometer(backend='sim')
+
+or, to configure the simulation:
+
+    from leuschner_sim import SimBackend
+    spec = Spectrometer(backend=SimBackend(dump_period=0.01, desync_every=100))
+
+The simulated objects implement the subset of the casperfpga/hera_corr_f
+interfaces used by leuschner: CasperFpga (is_connected, is_running,
+upload_to_ram_and_program, get_system_information), SnapFengine
+(is_programmed, align_adc, initialize, adc, pfb, corr_0, corr_1) and the
+correlator blocks (read_uint('acc_cnt'), set_input, read_bram,
+get_new_corr, set_acc_len, initialize).
+"""
+
+import numpy as np
+import tempfile
+import threading
+import time
+
+NCHAN = 1024
+ADC_RATE = 500e6 # Hz
+SPEC_PER_ACC = 8
+ACC_LEN = 38150
+ADC_NAME = 'hmcad1511'
+
+
+class SimState(object):
+    """
+    State shared by the simulated blocks of one board: the accumulation
+    clock, the synthetic sky and the injected faults.
+    """
+
+    def __init__(self, dump_period=None, time_scale=1., read_latency=0., adc_failures=0,
+                 align_failures=0, desync_every=0, stall_after=None, seed=0, clock=time.time):
+        """
+        Inputs:
+        - dump_period: Fixed time between accumulation dumps [s]. By default
+            it follows from ''acc_len'' like on the hardware.
+        - time_scale: Factor applied to the hardware dump period, e.g. 0.01
+            to run 100 times faster than real time.
+        - read_latency: Delay added to every register or BRAM read [s], to
+            mimic the katcp round trip.
+        - adc_failures, align_failures: Number of initial calls of
+            ''adc.init''/''align_adc'' that raise an error.
+        - desync_every: If set, every n-th acc_cnt read of corr_1 lags
+            corr_0 by one dump.
+        - stall_after: If set, acc_cnt stops advancing after this many dumps.
+        - seed: Seed of the synthetic noise.
+        - clock: Function returning the current time [s].
+        """
+        self.dump_period = dump_period
+        self.time_scale = time_scale
+        self.read_latency = read_latency
+        self.adc_failures = adc_failures
+        self.align_failures = align_failures
+        self.desync_every = desync_every
+        self.stall_after = stall_after
+        self.seed = seed
+        self.clock = clock
+
+        self.programmed = None
+        self.programmed_hash = None
+        self.uploads = 0
+        self.parses = 0
+        self.acc_len = ACC_LEN
+        self.spec_per_acc = SPEC_PER_ACC
+        self._t0 = clock()
+        self._cnt0 = 0
+        self._lock = threading.Lock()
+
+        # Synthetic sky: smooth bandpass with an HI-like line on top
+        chan = np.arange(NCHAN)
+        self.bandpass = 1e3*(1 + 0.3*np.sin(np.pi*chan/NCHAN))
+        self.bandpass *= 1 + 0.5*np.exp(-0.5*((chan - 0.6*NCHAN)/4.)**2)
+        self.phase = np.exp(2j*np.pi*chan/NCHAN*3.)
+        self._cache = {}
+
+    def period(self):
+        """
+        Time between accumulation dumps [s].
+        """
+        if self.dump_period is not None:
+            return self.dump_period
+        return self.time_scale*self.acc_len*self.spec_per_acc*2*NCHAN/ADC_RATE
+
+    def acc_cnt(self):
+        """
+        Current accumulation count.
+        """
+        cnt = self._cnt0 + int((self.clock() - self._t0)/self.period())
+        if self.stall_after is not None:
+            cnt = min(cnt, self.stall_after)
+        return cnt
+
+    def dump_time(self, cnt):
+        """
+        Time at which accumulation ''cnt'' was dumped.
+        """
+        return self._t0 + (cnt - self._cnt0)*self.period()
+
+    def set_acc_len(self, acc_len):
+        """
+        Change the accumulation length, keeping acc_cnt continuous.
+        """
+        with self._lock:
+            cnt = self.acc_cnt()
+            self.acc_len = acc_len
+            self._cnt0 = cnt
+            self._t0 = self.clock()
+
+    def wait(self):
+        """
+        Emulate the latency of a read over the network.
+        """
+        if self.read_latency:
+            time.sleep(self.read_latency)
+
+    def spectrum(self, cnt, pol1, pol2):
+        """
+        Raw (unnormalized) accumulator contents of dump ''cnt'' for the
+        product (pol1, pol2), as returned by ''read_bram''.
+        """
+        key = (cnt, pol1, pol2)
+        spec = self._cache.get(key)
+        if spec is None:
+            nacc = self.acc_len*self.spec_per_acc
+            rng = np.random.default_rng((self.seed, cnt, pol1, pol2))
+            noise = rng.standard_normal((2, NCHAN))/np.sqrt(nacc)
+            if pol1 == pol2:
+                power = self.bandpass*(1 + 0.1*pol1)*(1 + noise[0])
+                spec = np.round(nacc*power) + 0j
+            else:
+                power = 0.3*self.bandpass*self.phase + self.bandpass*(noise[0] + 1j*noise[1])
+                spec = np.round(nacc*power.real) + 1j*np.round(nacc*power.imag)
+            # Only the latest dumps can be read back
+            if len(self._cache) > 16:
+                self._cache.clear()
+            self._cache[key] = spec
+        return spec
+
+
+class SimCorr(object):
+    """
+    Simulated correlator block (hera_corr_f Corr).
+    """
+
+    def __init__(self, state, name):
+        self.state = state
+        self.name = name
+        self.acc_len = state.acc_len
+        self.spec_per_acc = state.spec_per_acc
+        self.pols = (0, 0)
+        self.nreads = 0
+
+    def initialize(self):
+        self.set_acc_len(self.acc_len)
+
+    def set_acc_len(self, acc_len):
+        self.acc_len = acc_len
+        self.state.set_acc_len(acc_len)
+
+    def set_input(self, pol1, pol2):
+        self.pols = (pol1, pol2)
+
+    def read_uint(self, register):
+        self.state.wait()
+        if register != 'acc_cnt':
+            return 0
+        cnt = self.state.acc_cnt()
+        self.nreads += 1
+        desync = self.state.desync_every
+        if self.name == 'corr_1' and desync and self.nreads % desync == 0:
+            cnt -= 1
+        return cnt
+
+    def wait_for_acc(self):
+        cnt = self.state.acc_cnt()
+        while self.state.acc_cnt() == cnt:
+            time.sleep(min(1e-3, self.state.period()/10.))
+        return cnt + 1
+
+    def read_bram(self, flush_vacc=True):
+        if flush_vacc:
+            self.wait_for_acc()
+        self.state.wait()
+        pol1, pol2 = self.pols
+        return self.state.spectrum(self.state.acc_cnt(), pol1, pol2).copy()
+
+    def get_new_corr(self, pol1, pol2, flush_vacc=True):
+        self.set_input(pol1, pol2)
+        if flush_vacc:
+            self.wait_for_acc()
+        spec = self.read_bram(flush_vacc=False)/float(self.acc_len*self.spec_per_acc)
+        if pol1 == pol2:
+            return spec.real + 1j*np.zeros(len(spec))
+        else:
+            return spec
+
+
+class _SimAdcChip(object):
+    name = ADC_NAME
+
+
+class SimAdc(object):
+    """
+    Simulated ADC block.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.adc = _SimAdcChip()
+
+    def init(self):
+        if self.state.adc_failures > 0:
+            self.state.adc_failures -= 1
+            raise RuntimeError('Simulated ADC initialization failure.')
+
+
+class SimPfb(object):
+    """
+    Simulated PFB block.
+    """
+
+    def initialize(self):
+        pass
+
+
+class SimCasperFpga(object):
+    """
+    Simulated casperfpga.CasperFpga.
+    """
+
+    def __init__(self, state, host):
+        self.state = state
+        self.host = host
+
+    def is_connected(self):
+        return True
+
+    def is_running(self):
+        return self.state.programmed is not None
+
+    def upload_to_ram_and_program(self, filename, **kwargs):
+        self.transport.upload_to_ram_and_program(filename, **kwargs)
+        self.get_system_information(filename)
+
+    def get_system_information(self, filename=None, fpg_info=None, **kwargs):
+        self.state.parses += filename is not None
+
+    @property
+    def transport(self):
+        return SimTransport(self.state)
+
+
+class SimTransport(object):
+    """
+    Simulated casperfpga transport.
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def upload_to_ram_and_program(self, filename, **kwargs):
+        self.state.programmed = filename
+        self.state.uploads += 1
+
+
+class SimSnapFengine(object):
+    """
+    Simulated hera_corr_f.SnapFengine.
+    """
+
+    def __init__(self, state, host):
+        self.state = state
+        self.fpga = SimCasperFpga(state, host)
+        self.adc = SimAdc(state)
+        self.pfb = SimPfb()
+        self.corr_0 = SimCorr(state, 'corr_0')
+        self.corr_1 = SimCorr(state, 'corr_1')
+
+    def is_programmed(self):
+        return self.state.programmed is not None
+
+    def align_adc(self):
+        if self.state.align_failures > 0:
+            self.state.align_failures -= 1
+            raise RuntimeError('Simulated ADC alignment failure.')
+
+    def initialize(self):
+        self.pfb.initialize()
+        self.corr_0.initialize()
+        self.corr_1.initialize()
+
+
+class SimBackend(object):
+    """
+    Spectrometer backend connecting to a simulated SNAP. Keyword arguments
+    configure the simulation (see ''SimState'').
+    """
+
+    def __init__(self, cache_dir=None, **kwargs):
+        """
+        Inputs:
+        - cache_dir: Directory for the parsed design metadata cache. 
+            Defaults to a temporary directory.
+        """
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp(prefix='leuschner_sim_')
+        self.cache_dir = cache_dir
+        self.state = SimState(**kwargs)
+
+    def connect(self, host, transport):
+        """
+        Returns:
+        - (fpga, snap) handles, like casperfpga.CasperFpga and
+          hera_corr_f.SnapFengine.
+        """
+        snap = SimSnapFengine(self.state, host)
+        return SimCasperFpga(self.state, host), snap
+
+    def parse_fpg(self, fpgfile):
+        """
+        Simulated design metadata.
+        """
+        self.state.parses += 1
+        return ({'fpgfile': fpgfile}, {})
+
+    def programmed_hash(self, host):
+        return self.state.programmed_hash
+
+    def record_programmed(self, host, fpgfile, digest):
+        self.state.programmed_hash = digest
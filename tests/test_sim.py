@@ -0,0 +1,180 @@
+"""
+Tests of the acquisition on the simulated SNAP (see ''leuschner_sim''):
+the files written by ''read_spec'' and read back by ''SpectrumReader'',
+resuming from a checkpoint, the dump accounting and the dump times.
+
+    python -m pytest -q tests
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(SRC)
+
+import leuschner
+from leuschner import Spectrometer, SpectrumReader, read_manifest
+from leuschner_sim import SimBackend
+
+FPGFILE = os.path.join(os.path.dirname(SRC), leuschner.FPGFILE)
+COORDS = (120., 0.)
+DUMP_PERIOD = 0.03 # s, far from the nominal 1.25 s of ACC_LEN
+
+
+def make_spectrometer(tmp_path, **kwargs):
+    """
+    Initialized spectrometer on a simulated SNAP configured by ''kwargs''
+    (see ''SimState''), logging to ''tmp_path''.
+    """
+    kwargs.setdefault('dump_period', DUMP_PERIOD)
+    spec = Spectrometer(fpgfile=FPGFILE, backend=SimBackend(cache_dir=str(tmp_path), **kwargs),
+                        logger=str(tmp_path / 'spectrometer.log'), wait_timeout=0.5)
+    spec.initialize()
+    return spec
+
+
+def stall_after_reads(state, ndumps):
+    """
+    Make the simulated SNAP stop dumping once ''ndumps'' dumps have been
+    read from it, whatever the load of the host.
+    """
+    spectrum = state.spectrum
+    seen = set()
+    def read(cnt, pol1, pol2):
+        seen.add(cnt)
+        if len(seen) >= ndumps and state.stall_after is None:
+            state.stall_after = cnt
+        return spectrum(cnt, pol1, pol2)
+    state.spectrum = read
+
+
+def resume_stall(state):
+    """
+    Let a simulated SNAP stalled by ''stall_after_reads'' dump again.
+    """
+    del state.spectrum
+    state.stall_after = None
+
+
+def expected_spectra(spec, acc_cnt):
+    """
+    Normalized autocorrelations the simulated SNAP dumped at ''acc_cnt''.
+    """
+    state = spec.backend.state
+    return dict((name + '_real', state.spectrum(acc_cnt, pol1, pol2).real*spec._norm)
+                for name, _, (pol1, pol2) in spec.default_products())
+
+
+def check_spectra(spec, reader, rtol):
+    """
+    Compare the spectra of a file to the dumps of the simulated SNAP.
+    Only integrations read from one dump (not desynced) are compared.
+    """
+    data = reader.read()
+    checked = 0
+    for i, (cnt, desync) in enumerate(zip(reader.meta['acc_cnt'], reader.meta['desync'])):
+        if desync:
+            continue
+        for name, expected in expected_spectra(spec, int(cnt)).items():
+            np.testing.assert_allclose(data[name][i], expected, rtol=rtol)
+        checked += 1
+    assert checked > 0
+
+
+@pytest.mark.parametrize('layout', ['hdu', 'table'])
+@pytest.mark.parametrize('encoding, rtol', [('float64', 1e-12), ('float32', 1e-6), ('int', 1e-12)])
+def test_read_spec_round_trip(tmp_path, layout, encoding, rtol):
+    spec = make_spectrometer(tmp_path)
+    filename = str(tmp_path / 'obs.fits')
+    summary = spec.read_spec(filename, 4, COORDS, layout=layout, encoding=encoding)
+    assert summary['nspec'] == 4
+
+    with SpectrumReader(filename) as reader:
+        assert reader.layout == layout
+        assert len(reader) == 4
+        assert sorted(reader.products) == ['auto0_real', 'auto1_real']
+        assert np.all(np.diff(reader.meta['acc_cnt']) > 0)
+        if encoding == 'int':
+            assert reader.columns[0][1] == '>i4'
+            assert reader.header['INTFMT'] == 'J'
+        check_spectra(spec, reader, rtol)
+    assert read_manifest(filename) is None
+
+
+@pytest.mark.parametrize('layout', ['hdu', 'table'])
+def test_resume_after_fault(tmp_path, layout):
+    spec = make_spectrometer(tmp_path)
+    state = spec.backend.state
+    filename = str(tmp_path / 'obs.fits')
+
+    # The SNAP stops dumping partway through the acquisition
+    stall_after_reads(state, 4)
+    with pytest.raises(TimeoutError):
+        spec.read_spec(filename, 8, COORDS, layout=layout, checkpoint_every=1)
+    manifest = read_manifest(filename)
+    assert manifest is not None
+    written = manifest['ndumps']
+    assert 0 < written < 8
+    with SpectrumReader(filename) as reader:
+        assert len(reader) == written
+
+    # The same call resumes from the checkpoint and completes the file
+    resume_stall(state)
+    summary = spec.read_spec(filename, 8, COORDS, layout=layout, checkpoint_every=1)
+    assert summary['nspec'] == 8
+    assert read_manifest(filename) is None
+    with SpectrumReader(filename) as reader:
+        assert len(reader) == 8
+        assert reader.header['NRESUME'] == 1
+        assert np.all(np.diff(reader.meta['acc_cnt']) > 0)
+        check_spectra(spec, reader, 1e-12)
+
+
+def test_skipped_dumps_after_stall(tmp_path):
+    spec = make_spectrometer(tmp_path)
+    state = spec.backend.state
+    filename = str(tmp_path / 'obs.fits')
+
+    stall_after_reads(state, 3)
+    with pytest.raises(TimeoutError):
+        spec.read_spec(filename, 6, COORDS, checkpoint_every=1)
+    written = read_manifest(filename)['ndumps']
+    assert 0 < written < 6
+    stalled_at = state.stall_after
+    resume_stall(state)
+    summary = spec.read_spec(filename, 6, COORDS, checkpoint_every=1)
+
+    with SpectrumReader(filename) as reader:
+        acc_cnt = reader.meta['acc_cnt']
+        gap = reader.meta['gap']
+        # The dumps lost while the SNAP was stalled are counted before
+        # the first resumed integration
+        assert acc_cnt[written] > stalled_at
+        assert gap[written] == acc_cnt[written] - acc_cnt[written - 1] - 1
+        assert np.array_equal(gap[1:], np.diff(acc_cnt) - 1)
+        assert reader.header['NMISSED'] == summary['missed']
+    assert summary['skipped'] == gap.sum()
+    assert summary['missed'] == summary['last_cnt'] - summary['first_cnt'] + 1 - summary['nspec']
+
+
+def test_fpga_times_non_nominal_period(tmp_path):
+    spec = make_spectrometer(tmp_path)
+    state = spec.backend.state
+    filename = str(tmp_path / 'obs.fits')
+    spec.read_spec(filename, 40, COORDS, layout='table')
+
+    with SpectrumReader(filename) as reader:
+        times = reader.times
+        true_times = np.array([state.dump_time(cnt) for cnt in times['acc_cnt']])
+        # The host sees the dumps late, the counter gives their time
+        assert np.all(times['unix'] >= true_times)
+        np.testing.assert_allclose(times['fpga_unix'], true_times, rtol=0, atol=2e-3)
+    with fits.open(filename) as hdulist:
+        header = hdulist[leuschner.TIMES_NAME].header
+        assert header['DUMPPER'] == pytest.approx(DUMP_PERIOD, rel=1e-2)
+        assert header['INTTIME'] == pytest.approx(spec.integration_time())
+        assert header['FPGATIME']